@@ -0,0 +1,223 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+import numpy as np
+import pandas as pd
+
+from data.data_processor import PropertyProcessor
+from data.training_cache import TrainingDataCache
+from src.models.cart import CARTRegressor
+from src.models.random_forest import RandomForestRegressor
+from src.models.knn import KNN
+from src.models.artifacts import save_artifact, load_artifact
+from src.utils.config import N_JOBS, RANDOM_SEED, PRICE_RANGE_QUANTILES
+
+RAW_CSV = os.path.join(BASE_DIR, '..', 'data', 'estates_raw_data.csv')
+RESULTS_DIR = os.path.join(BASE_DIR, 'results')
+SIZES = [1000, 10000, 100000, 1000000]
+GENERATE_CHUNK = 100000
+# Rows predicted by the inference stages; predicting all 1M rows would mostly measure the KNN query count
+QUERY_ROWS = 10000
+# Same model settings as train_and_save_models / run_detailed_validation
+RF_PARAMS = {'n_trees': 15, 'max_depth': 10}
+CART_PARAMS = {'max_depth': 10}
+KNN_PARAMS = {'k': 15}
+
+
+def generate_listings(n_rows, output_path, seed=RANDOM_SEED):
+    # Synthetic listings with the schema of estates_raw_data.csv: the bundled rows are resampled with jittered
+    # areas (prices follow the area), floors redrawn within the building and some rooms / years blanked to 0,
+    # so the cleaning stages have work to do. Written in chunks; the 1M-row file is a few GB of descriptions.
+    raw = pd.read_csv(RAW_CSV, sep=',', encoding='utf-8')
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_rows, GENERATE_CHUNK):
+        size = min(GENERATE_CHUNK, n_rows - start)
+        chunk = raw.iloc[rng.integers(0, len(raw), size)].reset_index(drop=True)
+
+        scale = rng.uniform(0.85, 1.15, size)
+        chunk['Area'] = np.maximum(np.round(chunk['Area'] * scale), 10).astype(np.int64)
+        chunk['Price'] = np.round(chunk['Price'] * scale * rng.uniform(0.95, 1.05, size), -2).astype(np.int64)
+        floors = np.maximum(chunk['Total_Floors'].to_numpy(), 1)
+        chunk['Floor_Number'] = rng.integers(0, floors + 1)
+        chunk['Is_First_Floor'] = (chunk['Floor_Number'] <= 1).astype(np.int64)
+        chunk['Is_Last_Floor'] = (chunk['Floor_Number'] == floors).astype(np.int64)
+        chunk.loc[rng.random(size) < 0.05, 'Rooms'] = 0
+        chunk.loc[rng.random(size) < 0.10, 'Construction_Year'] = 0
+        chunk['Url'] = [f'https://example.com/listing/{i}' for i in range(start, start + size)]
+        chunk.to_csv(output_path, index=False, mode='w' if start == 0 else 'a', header=start == 0)
+
+
+def _reset_peak_rss():
+    # Linux only: resets the VmHWM high-water mark of this process; False where that is not possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+def run_stage(func, repeats, memory):
+    # Best wall time of `repeats` runs. Peak memory comes from one extra run, kept apart so the tracing overhead
+    # never shows up in the timings: peak_mb is what tracemalloc saw allocated (Python objects and NumPy buffers;
+    # not Arrow-backed pandas strings, nor worker processes) and, on Linux, peak_rss_mb the process high-water mark.
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    stage = {'seconds': min(times), 'times': times}
+    if memory:
+        rss = _reset_peak_rss()
+        tracemalloc.start()
+        try:
+            func()
+            stage['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+        if rss:
+            stage['peak_rss_mb'] = _peak_rss_mb()
+    return stage, result
+
+
+def fitted(model, X, y):
+    model.fit(X, y)
+    return model
+
+
+def benchmark_size(n_rows, work_dir, repeats, memory, n_jobs):
+    raw_csv = os.path.join(work_dir, f'listings_{n_rows}.csv')
+    processed_csv = os.path.join(work_dir, f'processed_{n_rows}.csv')
+    model_dir = os.path.join(work_dir, f'models_{n_rows}')
+
+    start = time.perf_counter()
+    if not os.path.exists(raw_csv):
+        generate_listings(n_rows, raw_csv)
+    print(f"{n_rows} rows: generated in {time.perf_counter() - start:.1f} s")
+
+    def preprocess():
+        # process_data reports progress on stdout; its encoder files go next to processed_csv in work_dir
+        with contextlib.redirect_stdout(io.StringIO()):
+            PropertyProcessor().process_data(raw_csv, processed_csv)
+
+    stages = {}
+    stages['preprocess'], _ = run_stage(preprocess, repeats, memory)
+
+    # Loaded the way load_training_data does it: rows with missing values dropped, arrays memory-mapped
+    X, y = TrainingDataCache(processed_csv, cache_dir=work_dir).load()
+    X_query = X[:QUERY_ROWS]
+
+    stages['cart_fit'], _ = run_stage(lambda: fitted(CARTRegressor(**CART_PARAMS), X, y), repeats, memory)
+    stages['rf_fit'], rf = run_stage(lambda: fitted(RandomForestRegressor(n_jobs=n_jobs, **RF_PARAMS), X, y),
+                                     repeats, memory)
+    stages['rf_predict'], _ = run_stage(lambda: rf.predict(X_query), repeats, memory)
+    stages['rf_predict_range'], _ = run_stage(lambda: rf.predict_distribution(X_query, PRICE_RANGE_QUANTILES),
+                                              repeats, memory)
+    stages['knn_fit'], knn = run_stage(lambda: fitted(KNN(**KNN_PARAMS), X, y), repeats, memory)
+    stages['knn_predict'], _ = run_stage(lambda: knn.predict(X_query), repeats, memory)
+    stages['knn_predict_range'], _ = run_stage(lambda: knn.predict_distribution(X_query, PRICE_RANGE_QUANTILES),
+                                               repeats, memory)
+    stages['artifact_save'], _ = run_stage(lambda: save_artifact(model_dir, {'rf': rf, 'knn': knn}), repeats, memory)
+    stages['artifact_load'], _ = run_stage(lambda: load_artifact(model_dir), repeats, memory)
+
+    for name in ('rf_predict', 'rf_predict_range', 'knn_predict', 'knn_predict_range'):
+        stages[name]['rows'] = len(X_query)
+        stages[name]['us_per_row'] = stages[name]['seconds'] / len(X_query) * 1e6
+    return {'raw_rows': n_rows, 'processed_rows': len(X), 'stages': stages}
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASE_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ''
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def environment(n_jobs):
+    commit, dirty = git_revision()
+    return {'commit': commit, 'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'n_jobs': n_jobs}
+
+
+def print_results(results, baseline=None):
+    # With a baseline (an earlier results file) every timing is followed by its ratio to the baseline's
+    for size, result in results.items():
+        print(f"\n{size} rows ({result['processed_rows']} after preprocessing)")
+        base_stages = baseline.get('results', {}).get(size, {}).get('stages', {}) if baseline else {}
+        for name, stage in result['stages'].items():
+            line = f"  {name:<17} {stage['seconds'] * 1000:>12.1f} ms"
+            if 'peak_mb' in stage:
+                line += f" {stage['peak_mb']:>10.1f} MB"
+            if 'peak_rss_mb' in stage:
+                line += f" {stage['peak_rss_mb']:>10.1f} MB rss"
+            if name in base_stages:
+                line += f"   x{stage['seconds'] / base_stages[name]['seconds']:.2f} vs baseline"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timings and peak memory of preprocessing, training, inference and "
+                                                 "artifact loading on synthetic listings")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeats', type=int, default=1, help="timed runs per stage; the best one is reported")
+    parser.add_argument('--no-memory', action='store_true', help="skip the extra traced run per stage")
+    parser.add_argument('--n-jobs', type=int, default=N_JOBS)
+    parser.add_argument('--work-dir', default=None, help="keeps the generated CSVs for later runs (default: temp dir)")
+    parser.add_argument('--output', default=None, help=f"results JSON (default: {RESULTS_DIR}/<commit>.json)")
+    parser.add_argument('--compare', default=None, help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='estate_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    report = {'environment': environment(args.n_jobs), 'results': {}}
+    try:
+        for n_rows in args.sizes:
+            report['results'][str(n_rows)] = benchmark_size(n_rows, work_dir, args.repeats, not args.no_memory,
+                                                            args.n_jobs)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{(report['environment']['commit'] or 'results')[:10]}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(report['results'], baseline)
+    print(f"\nResults saved to: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+import numpy as np
+import pandas as pd
+
+from src.app_logic import MODEL_DIR
+from src.models.artifacts import load_header
+
+RAW_CSV = os.path.join(BASE_DIR, '..', 'data', 'estates_raw_data.csv')
+LISTING_COLUMNS = ['Rooms', 'Area', 'Floor_Number', 'Total_Floors', 'Construction_Year', 'District',
+                   'Construction_Type', 'Has_Garage', 'Is_Closed_Complex']
+AREA_JITTER = 0.05
+
+
+def sample_listings(n, encoders=None, seed=0, jitter=AREA_JITTER):
+    # Request bodies built from the bundled raw listings (optionally only districts / types the models know).
+    # There are only about 1k of them, so the area of every body is moved by up to +-jitter (a share) to keep
+    # the server's prediction cache from answering most requests; jitter=0 replays the listings as they are.
+    df = pd.read_csv(RAW_CSV, sep=',', encoding='utf-8', usecols=LISTING_COLUMNS).dropna()
+    if encoders:
+        df = df[df['District'].isin(encoders['District']) & df['Construction_Type'].isin(encoders['Construction_Type'])]
+    records = df.to_dict('records')
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(n):
+        listing = dict(rng.choice(records))
+        if jitter:
+            listing['Area'] = round(listing['Area'] * (1 + rng.uniform(-jitter, jitter)), 2)
+        bodies.append(json.dumps(listing, ensure_ascii=False).encode('utf-8'))
+    return bodies
+
+
+async def request(reader, writer, host, method, path, body=b''):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.decode('latin-1').split('\r\n')[1:]:
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, bodies, latencies, errors):
+    # One keep-alive connection sending its requests back to back
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, 'POST', '/predict', body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def get_json(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, body = await request(reader, writer, host, 'GET', path)
+        return json.loads(body)
+    finally:
+        writer.close()
+
+
+async def run(host, port, n_requests, concurrency, jitter=AREA_JITTER):
+    health = await get_json(host, port, '/health')
+    bodies = sample_listings(n_requests, load_header(MODEL_DIR)['encoders'], jitter=jitter)
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, bodies[i::concurrency], latencies, errors) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    after = await get_json(host, port, '/health')
+
+    latencies = np.array(latencies) * 1000
+    batches = after['batches'] - health['batches']
+    rows = after['rows'] - health['rows']
+    print(f"{n_requests} requests, {concurrency} connections, {elapsed:.2f} s")
+    print(f"throughput: {n_requests / elapsed:,.0f} req/s, errors: {len(errors)}")
+    print(f"latency ms: p50 {np.percentile(latencies, 50):.2f} | p90 {np.percentile(latencies, 90):.2f} | "
+          f"p99 {np.percentile(latencies, 99):.2f} | max {latencies.max():.2f}")
+    print(f"server batches: {batches}, mean batch size {rows / max(batches, 1):.1f}")
+    # Cache hits skip the batcher, so the latencies above only measure the micro-batching when the hit rate is low
+    if health.get('cache') and after.get('cache'):
+        hits = after['cache']['hits'] - health['cache']['hits']
+        misses = after['cache']['misses'] - health['cache']['misses']
+        print(f"cache hits: {hits} of {hits + misses} lookups ({hits / max(hits + misses, 1):.1%})")
+    else:
+        print("cache: disabled")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for src/server.py. To measure the micro-batching "
+                                                 "alone, start the server with --cache-size 0")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--jitter', type=float, default=AREA_JITTER,
+                        help="largest relative change of the area of a listing; 0 sends the bundled listings "
+                             "unchanged, which the server's cache mostly answers")
+    args = parser.parse_args()
+    asyncio.run(run(args.host, args.port, args.requests, args.concurrency, args.jitter))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+import numpy as np
+import pandas as pd
+
+from data.data_processor import PropertyProcessor, impute_rooms_by_area
+
+RAW_CSV = os.path.join(BASE_DIR, '..', 'data', 'estates_raw_data.csv')
+FEATURES = ['Rooms', 'Area', 'Construction_Year']
+
+
+def legacy_impute_rooms_by_area(row):
+    # Row-wise version the cleaning stage used before impute_rooms_by_area was vectorized
+    rooms = row['Rooms']
+    area = row['Area']
+
+    if pd.isna(rooms) or rooms <= 0:
+        if area < 45:
+            return 1
+        elif area < 75:
+            return 2
+        elif area < 115:
+            return 3
+        elif area < 160:
+            return 4
+        else:
+            return 5
+    return rooms
+
+
+def legacy_cleaning(df):
+    df['Rooms'] = df.apply(legacy_impute_rooms_by_area, axis=1)
+    median_year = df[df['Construction_Year'] > 0]['Construction_Year'].median()
+    df.loc[df['Construction_Year'] <= 0, 'Construction_Year'] = median_year
+    processed_df = pd.concat([df[FEATURES], df['Price']], axis=1)
+    return processed_df[processed_df['Price'] > 0]
+
+
+def vectorized_cleaning(df, breakpoints):
+    impute_rooms_by_area(df, breakpoints)
+    years = df['Construction_Year']
+    df.loc[years <= 0, 'Construction_Year'] = years.where(years > 0).median()
+    processed_df = df[FEATURES + ['Price']]
+    return processed_df[processed_df['Price'] > 0]
+
+
+def best_time(func, df, repeats):
+    # Each run gets a fresh copy because both versions modify the frame in place
+    times = []
+    for _ in range(repeats):
+        data = df.copy()
+        start = time.perf_counter()
+        result = func(data)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rooms imputation / year fixing: row-wise apply vs column transforms")
+    parser.add_argument('--scale', type=int, default=100, help="how many times the raw CSV is repeated")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    raw = pd.read_csv(RAW_CSV, sep=',', encoding='utf-8').drop(columns=['Description', 'Url'])
+    df = pd.concat([raw] * args.scale, ignore_index=True)
+    breakpoints = PropertyProcessor().room_area_breakpoints
+    print(f"{len(df)} rows ({args.scale}x {os.path.basename(RAW_CSV)}), "
+          f"{int((df['Rooms'].isna() | (df['Rooms'] <= 0)).sum())} with rooms to impute")
+
+    legacy_time, legacy_result = best_time(legacy_cleaning, df, args.repeats)
+    vectorized_time, vectorized_result = best_time(lambda data: vectorized_cleaning(data, breakpoints), df, args.repeats)
+
+    same = np.array_equal(legacy_result.to_numpy(dtype=np.float64), vectorized_result.to_numpy(dtype=np.float64),
+                          equal_nan=True)
+    print(f"{'row-wise apply':<20} {legacy_time * 1000:>10.1f} ms")
+    print(f"{'column transforms':<20} {vectorized_time * 1000:>10.1f} ms")
+    print(f"speedup: {legacy_time / vectorized_time:.1f}x, identical output: {same}")
+
+
+if __name__ == "__main__":
+    main()
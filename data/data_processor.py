@@ -1,24 +1,60 @@
+import os
+import json
+
 import pandas as pd
 import numpy as np
-from data.label_encoder import LabelEncoder
+from data.label_encoder import LabelEncoder, UNKNOWN
+from src.utils.instrumentation import metrics
+from src.utils.utils import rooms_by_area
+
+# Number of characters before a vocabulary term that are searched for a negation
+NEGATION_WINDOW = 15
+# Rows per chunk in process_data_streaming; peak memory is proportional to it, not to the file size
+CHUNK_SIZE = 50000
+CATEGORICAL_COLUMNS = ['District', 'Construction_Type']
+# Per-district listing counts and median prices, written next to the processed CSV
+DISTRICT_AGGREGATES_FILE = 'District_aggregates.json'
+
+
+def median_from_counts(counts):
+    # Same value as Series.median() over the expanded data, from a value -> count table
+    if len(counts) == 0:
+        return np.nan
+    values = np.asarray(sorted(counts), dtype=np.float64)
+    cumulative = np.cumsum([counts[v] for v in sorted(counts)])
+    n = cumulative[-1]
+    lower = values[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+    upper = values[np.searchsorted(cumulative, n // 2, side='right')]
+    return (lower + upper) / 2
+
+
+def count_district_values(codes, values, counts):
+    # In place: adds the rows of one chunk to the per-district value -> count tables in counts ({code: {value: n}})
+    grouped = pd.Series(1, index=pd.MultiIndex.from_arrays([codes, values])).groupby(level=[0, 1]).size()
+    for (code, value), n in grouped.items():
+        table = counts.setdefault(int(code), {})
+        table[value] = table.get(value, 0) + n
+
 
+def district_aggregates(price_counts, price_per_m2_counts, districts):
+    # Per-district listing count, median price and median price per m2, as lists indexed by the district code,
+    # so scoring joins them with one array lookup per row. Built from the count tables of count_district_values,
+    # so streaming keeps one entry per distinct value instead of one per row.
+    table = {'districts': list(districts), 'count': [], 'median_price': [], 'median_price_per_m2': []}
+    for code in range(len(districts)):
+        prices = price_counts.get(code, {})
+        table['count'].append(int(sum(prices.values())))
+        for column, counts in (('median_price', prices), ('median_price_per_m2', price_per_m2_counts.get(code, {}))):
+            table[column].append(float(median_from_counts(counts)) if counts else None)
+    return table
 
-def impute_rooms_by_area(row):
-    rooms = row['Rooms']
-    area = row['Area']
 
-    if pd.isna(rooms) or rooms <= 0:
-        if area < 45:
-            return 1
-        elif area < 75:
-            return 2
-        elif area < 115:
-            return 3
-        elif area < 160:
-            return 4
-        else:
-            return 5
-    return rooms
+def impute_rooms_by_area(df, breakpoints):
+    # In place: rooms that are missing or not positive get the room count of their area bucket (rooms_by_area)
+    rooms = df['Rooms']
+    missing = (rooms.isna() | (rooms <= 0)).to_numpy()
+    if missing.any():
+        df.loc[missing, 'Rooms'] = rooms_by_area(df['Area'].to_numpy(dtype=np.float64)[missing], breakpoints)
 
 
 class PropertyProcessor:
@@ -30,64 +66,184 @@ class PropertyProcessor:
             'ext_is_act16': ['акт 16', 'акт-16', 'разрешение за ползване']
         }
         self.negations = ['без', 'няма', 'не']
+        # Upper area bounds (exclusive, m²) of the 1-, 2-, 3- and 4-room buckets used to impute missing rooms
+        self.room_area_breakpoints = [45, 75, 115, 160]
         self.label_encoders = {}
 
+    def _compile_text_matcher(self):
+        # Flat (term, bit) table built once per run; a description's flags are collected into one bitmask
+        terms = tuple((var, 1 << col) for col, variations in enumerate(self.vocabulary.values()) for var in variations)
+        return terms, tuple(self.negations), (1 << len(self.vocabulary)) - 1
+
+    def _scan_text(self, text, matcher):
+        # Same rule as before: only the first occurrence of each variation is checked, and it counts unless
+        # a negation word lies within the NEGATION_WINDOW characters before it
+        terms, negations, all_found = matcher
+        found = 0
+        for var, bit in terms:
+            if found & bit:
+                continue
+            idx = text.find(var)
+            if idx >= 0:
+                snippet = text[max(0, idx - NEGATION_WINDOW):idx]
+                if not any(neg in snippet for neg in negations):
+                    found |= bit
+                    if found == all_found:
+                        break
+        return found
+
+    def extract_text_features(self, descriptions):
+        # Integer flag columns for a whole Series of descriptions. Descriptions that are not text get missing flags
+        # (as extract_from_text has always produced), so those rows are dropped when the training data is loaded.
+        matcher = self._compile_text_matcher()
+        masks = np.fromiter(
+            (self._scan_text(text.lower(), matcher) if isinstance(text, str) else -1 for text in descriptions),
+            dtype=np.int64, count=len(descriptions))
+        missing = masks < 0
+
+        return pd.DataFrame({
+            feature: pd.arrays.IntegerArray(((masks >> col) & 1).astype(np.int8), missing.copy())
+            for col, feature in enumerate(self.vocabulary.keys())
+        }, index=descriptions.index)
+
     def extract_from_text(self, text):
         if not isinstance(text, str): return pd.Series([0] * len(self.vocabulary))
-        text = text.lower()
-        results = {}
-        for feature, variations in self.vocabulary.items():
-            found = 0
-            for var in variations:
-                if var in text:
-                    idx = text.find(var)
-                    snippet = text[max(0, idx - 15):idx]
-                    if not any(neg in snippet for neg in self.negations):
-                        found = 1
-                        break
-            results[feature] = found
-        return pd.Series(results)
+        found = self._scan_text(text.lower(), self._compile_text_matcher())
+        return pd.Series({feature: (found >> col) & 1 for col, feature in enumerate(self.vocabulary.keys())})
 
-    def process_data(self, input_path, output_path):
-        df = pd.read_csv(input_path, sep=',', encoding='utf-8')
+    def config(self):
+        # Everything that shapes the processed output; caches of that output are keyed on it
+        return {
+            'vocabulary': self.vocabulary,
+            'negations': self.negations,
+            'negation_window': NEGATION_WINDOW,
+            'room_area_breakpoints': self.room_area_breakpoints,
+            'features': self._features_to_keep(),
+        }
 
-        print("Step 1: Extracting hidden features from text...")
-        extracted_features = df['Description'].apply(self.extract_from_text)
-        df = pd.concat([df, extracted_features], axis=1)
+    def _features_to_keep(self):
+        return [
+                   'Rooms', 'Area', 'Floor_Number', 'Total_Floors', 'Construction_Year',
+                   'Is_First_Floor', 'Is_Last_Floor', 'Has_Garage', 'Is_Closed_Complex',
+                   'District_Encoded', 'Construction_Type_Encoded'
+               ] + list(self.vocabulary.keys())
 
-        print("Step 1.5: Imputing missing rooms based on area...")
-        df['Rooms'] = df.apply(impute_rooms_by_area, axis=1)
+    def _transform(self, df, median_year):
+        # Row-local steps shared by the in-memory and the streaming paths; encoders must already be fitted
+        metrics.count('preprocess.rows', len(df))
+        with metrics.timer('preprocess.text_features'):
+            extracted_features = self.extract_text_features(df['Description'])
+        for feature in extracted_features.columns:
+            df[feature] = extracted_features[feature]
 
-        print("Step 2: Encoding categorical data...")
-        categorical_cols = ['District', 'Construction_Type']
-        for col in categorical_cols:
-            encoder = LabelEncoder()
-            encoder.fit(df[col].astype(str))
-            df[f'{col}_Encoded'] = encoder.transform(df[col].astype(str))
-            self.label_encoders[col] = encoder  # Save encoder for later use
+        with metrics.timer('preprocess.impute_and_encode'):
+            impute_rooms_by_area(df, self.room_area_breakpoints)
 
-        median_year = df[df['Construction_Year'] > 0]['Construction_Year'].median()
-        df.loc[df['Construction_Year'] <= 0, 'Construction_Year'] = median_year
+            for col, encoder in self.label_encoders.items():
+                df[f'{col}_Encoded'] = encoder.transform(df[col].astype(str))
 
-        features_to_keep = [
-                               'Rooms', 'Area', 'Floor_Number', 'Total_Floors', 'Construction_Year',
-                               'Is_First_Floor', 'Is_Last_Floor', 'Has_Garage', 'Is_Closed_Complex',
-                               'District_Encoded', 'Construction_Type_Encoded'
-                           ] + list(self.vocabulary.keys())
+            df.loc[df['Construction_Year'] <= 0, 'Construction_Year'] = median_year
+        return df[self._features_to_keep() + ['Price']]
 
-        X = df[features_to_keep]
-        y = df['Price']
+    def process_delta(self, df, vocabularies, median_year):
+        # New listings processed with the statistics of the data the models were trained on: the encoder
+        # vocabularies and the median construction year. Listings with a district or construction type the
+        # encoders do not know are dropped. Returns the processed rows with a positive price.
+        known = np.ones(len(df), dtype=bool)
+        for col in CATEGORICAL_COLUMNS:
+            encoder = LabelEncoder.from_mapping(vocabularies[col])
+            self.label_encoders[col] = encoder
+            known &= encoder.transform(df[col].astype(str)) != UNKNOWN
 
-        processed_df = pd.concat([X, y], axis=1)
-        processed_df = processed_df[processed_df['Price'] > 0]
-        processed_df.to_csv(output_path, index=False)
+        processed_df = self._transform(df[known].copy(), median_year)
+        return processed_df[processed_df['Price'] > 0]
 
+    def _save_encoders(self, output_path):
+        # Next to the processed CSV whose codes they describe, where artifact_metadata picks them up
+        data_dir = os.path.dirname(os.path.abspath(output_path))
         for col, encoder in self.label_encoders.items():
-            encoder.save(f'{col}_encoder.json')
+            encoder.save(os.path.join(data_dir, f'{col}_encoder.json'))
+
+    def _count_district_values(self, processed_df, price_counts, price_per_m2_counts):
+        # Rows without a positive area count towards the listings and the median price, not the price per m2
+        count_district_values(processed_df['District_Encoded'], processed_df['Price'], price_counts)
+        with_area = processed_df[processed_df['Area'] > 0]
+        count_district_values(with_area['District_Encoded'], with_area['Price'] / with_area['Area'],
+                              price_per_m2_counts)
+
+    def _save_district_aggregates(self, output_path, price_counts, price_per_m2_counts):
+        # Next to the encoders
+        encoder = self.label_encoders['District']
+        districts = [encoder.reverse_mapping[code] for code in range(len(encoder.reverse_mapping))]
+        path = os.path.join(os.path.dirname(os.path.abspath(output_path)), DISTRICT_AGGREGATES_FILE)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(district_aggregates(price_counts, price_per_m2_counts, districts), f, ensure_ascii=False)
+
+    def process_data(self, input_path, output_path):
+        with metrics.timer('preprocess.read'):
+            df = pd.read_csv(input_path, sep=',', encoding='utf-8')
+
+        print("Step 1: Fitting encoders and the construction year median...")
+        with metrics.timer('preprocess.fit_encoders'):
+            for col in CATEGORICAL_COLUMNS:
+                self.label_encoders[col] = LabelEncoder().fit(df[col].astype(str))  # Save encoder for later use
+            years = df['Construction_Year']
+            median_year = years.where(years > 0).median()
+
+        print("Step 2: Extracting text features, imputing rooms and encoding categorical data...")
+        processed_df = self._transform(df, median_year)
+        with metrics.timer('preprocess.write'):
+            processed_df[processed_df['Price'] > 0].to_csv(output_path, index=False)
+        X = processed_df.drop(columns='Price')
+        y = processed_df['Price']
+
+        self._save_encoders(output_path)
+        price_counts, price_per_m2_counts = {}, {}
+        self._count_district_values(processed_df[processed_df['Price'] > 0], price_counts, price_per_m2_counts)
+        self._save_district_aggregates(output_path, price_counts, price_per_m2_counts)
 
         print(f"Processing complete! Data saved to: {output_path}")
         return X, y
 
+    def process_data_streaming(self, input_path, output_path, chunksize=CHUNK_SIZE):
+        # Same output as process_data for inputs that do not fit in memory. The first pass reads only the columns
+        # behind the dataset-wide statistics; the second transforms one chunk at a time and appends it to the output.
+        print("Pass 1: Collecting label vocabularies and the construction year median...")
+        with metrics.timer('preprocess.fit_encoders'):
+            vocabularies = {col: set() for col in CATEGORICAL_COLUMNS}
+            year_counts = {}
+            for chunk in pd.read_csv(input_path, sep=',', encoding='utf-8', chunksize=chunksize,
+                                     usecols=CATEGORICAL_COLUMNS + ['Construction_Year']):
+                for col in CATEGORICAL_COLUMNS:
+                    vocabularies[col].update(chunk[col].astype(str))
+                years = chunk.loc[chunk['Construction_Year'] > 0, 'Construction_Year'].value_counts()
+                for year, count in years.items():
+                    year_counts[year] = year_counts.get(year, 0) + count
+
+            for col in CATEGORICAL_COLUMNS:
+                self.label_encoders[col] = LabelEncoder().fit(vocabularies[col])
+            median_year = median_from_counts(year_counts)
+
+        print("Pass 2: Transforming chunks...")
+        n_rows = 0
+        # Per-district price and price per m2 counts; their size depends on the distinct values, not the rows
+        price_counts, price_per_m2_counts = {}, {}
+        # The raw columns that are not used (Url) are never parsed
+        for i, chunk in enumerate(pd.read_csv(input_path, sep=',', encoding='utf-8', chunksize=chunksize,
+                                              usecols=lambda c: c != 'Url')):
+            processed_df = self._transform(chunk, median_year)
+            processed_df = processed_df[processed_df['Price'] > 0]
+            with metrics.timer('preprocess.write'):
+                processed_df.to_csv(output_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            n_rows += len(processed_df)
+            self._count_district_values(processed_df, price_counts, price_per_m2_counts)
+
+        self._save_encoders(output_path)
+        self._save_district_aggregates(output_path, price_counts, price_per_m2_counts)
+
+        print(f"Processing complete! {n_rows} rows saved to: {output_path}")
+        return n_rows
+
 
 if __name__ == "__main__":
     processor = PropertyProcessor()
@@ -1,22 +1,52 @@
 import json
 
+import numpy as np
+
+# Code of the values the encoder was not fitted on
+UNKNOWN = -1
+
 class LabelEncoder:
     def __init__(self):
         self.mapping = {}      # Text -> Number
         self.reverse_mapping = {} # Number -> Text
+        self._lookup_table = None
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        encoder = cls()
+        encoder.mapping = dict(mapping)
+        encoder.reverse_mapping = {index: value for value, index in encoder.mapping.items()}
+        return encoder
 
     def fit(self, data):
         unique_values = sorted(list(set(data)))
         for index, value in enumerate(unique_values):
             self.mapping[value] = index
             self.reverse_mapping[index] = value
+        self._lookup_table = None
         return self
 
+    def _lookup(self):
+        # Known values as a sorted array next to their codes, built once per vocabulary (NumPy only, so importing
+        # the encoder stays cheap for the GUI)
+        if self._lookup_table is None:
+            values = np.array(list(self.mapping.keys()), dtype=str)
+            codes = np.fromiter(self.mapping.values(), dtype=np.int64, count=len(self.mapping))
+            order = np.argsort(values, kind='stable')
+            self._lookup_table = (values[order], codes[order])
+        return self._lookup_table
+
     def transform(self, data):
-        return [self.mapping[v] for v in data]
+        # Whole column at once by binary search; values outside the vocabulary get UNKNOWN instead of raising
+        values, codes = self._lookup()
+        data = np.asarray(data, dtype=str)
+        if len(values) == 0:
+            return np.full(data.shape, UNKNOWN, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(values, data), len(values) - 1)
+        return np.where(values[positions] == data, codes[positions], UNKNOWN)
 
     def inverse_transform(self, data):
-        return [self.reverse_mapping[v] for v in data]
+        return [self.reverse_mapping.get(v) for v in np.asarray(data).tolist()]
 
     def save(self, file_path):
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -26,5 +56,7 @@ class LabelEncoder:
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
             self.mapping = data['mapping']
-            self.reverse_mapping = data['reverse_mapping']
-        return self
\ No newline at end of file
+            # JSON object keys are always strings; the codes are ints again after loading
+            self.reverse_mapping = {int(index): value for index, value in data['reverse_mapping'].items()}
+        self._lookup_table = None
+        return self
@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from data.data_processor import PropertyProcessor
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+# Bump when the layout of the cached files changes
+CACHE_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _save_npy(path, array):
+    # Written under a temporary name first, so a reader never maps a half-written file
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(path + '.tmp', path)
+
+
+class TrainingDataCache:
+    # Processed feature matrix and target kept as a pair of .npy files next to a JSON index. The CSV is parsed
+    # only when its content or the processor config changes; otherwise both arrays are memory-mapped read-only.
+    def __init__(self, source_csv, cache_dir=CACHE_DIR, processor=None, target='Price'):
+        self.source_csv = source_csv
+        self.cache_dir = cache_dir
+        self.processor = processor or PropertyProcessor()
+        self.target = target
+        self.feature_names = None
+
+        name = os.path.splitext(os.path.basename(source_csv))[0]
+        self.X_path = os.path.join(cache_dir, f'{name}.X.npy')
+        self.y_path = os.path.join(cache_dir, f'{name}.y.npy')
+        self.index_path = os.path.join(cache_dir, f'{name}.json')
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _source_digest(self, index):
+        # Hashing is skipped while the file's size and modification time are the ones recorded with the cache
+        stat = os.stat(self.source_csv)
+        source = index.get('source', {})
+        if source.get('size') == stat.st_size and source.get('mtime_ns') == stat.st_mtime_ns:
+            return source['digest']
+        return file_digest(self.source_csv)
+
+    def key(self, index=None):
+        digest = hashlib.sha256()
+        digest.update(str(CACHE_VERSION).encode('utf-8'))
+        digest.update(self._source_digest(self._read_index() if index is None else index).encode('utf-8'))
+        digest.update(json.dumps(self.processor.config(), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        digest.update(self.target.encode('utf-8'))
+        return digest.hexdigest()
+
+    def is_valid(self):
+        index = self._read_index()
+        return (index.get('key') == self.key(index)
+                and os.path.exists(self.X_path) and os.path.exists(self.y_path))
+
+    def load(self):
+        if not self.is_valid():
+            self.build()
+        self.feature_names = self._read_index()['feature_names']
+        return np.load(self.X_path, mmap_mode='r'), np.load(self.y_path, mmap_mode='r')
+
+    def build(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        train_df = pd.read_csv(self.source_csv, dtype=np.float64).dropna()
+        _save_npy(self.X_path, train_df.drop(self.target, axis=1).to_numpy())
+        _save_npy(self.y_path, train_df[self.target].to_numpy())
+
+        stat = os.stat(self.source_csv)
+        index = {
+            'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': file_digest(self.source_csv)},
+            'feature_names': [c for c in train_df.columns if c != self.target],
+            'rows': len(train_df),
+        }
+        index['key'] = self.key(index)
+        # The index is written last: it only names a key once both arrays for that key are in place
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
@@ -1,84 +1,283 @@
 import os
-import pickle
-import pandas as pd
+import json
+import numpy as np
 
 from src.models.cart import CARTRegressor
-from src.utils.utils import calculate_metrics, train_test_split
+from src.utils.utils import calculate_metrics, train_test_split, rooms_by_area
 from src.models.random_forest import RandomForestRegressor
 from src.models.knn import KNN
+from src.models.artifacts import save_artifact, load_artifact, load_header, artifact_exists, update_metadata
+from src.utils.config import N_JOBS, KNN_PRECISION, KNN_RERANK, PRICE_RANGE_QUANTILES, ROLLING_WINDOW, TEST_SIZE
+from src.utils.prediction_cache import invalidate_all
+from src.utils.instrumentation import metrics
+from data.label_encoder import LabelEncoder, UNKNOWN
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(BASE_DIR, 'models_saved')
-RF_PATH = os.path.join(MODEL_DIR, 'rf_model.pkl')
-KNN_PATH = os.path.join(MODEL_DIR, 'knn_model.pkl')
+ENCODED_COLUMNS = ['District', 'Construction_Type']
+# Weights of the random forest and the KNN estimate in the final price
+RF_WEIGHT = 0.7
+KNN_WEIGHT = 0.3
+# Flag inputs of a listing (GUI checkboxes / batch columns); missing ones count as 0
+FLAG_COLUMNS = ['Has_Garage', 'Is_Closed_Complex', 'ext_has_gas', 'ext_has_tep', 'ext_is_luxury', 'ext_is_act16']
 
 if not os.path.exists(MODEL_DIR):
     os.makedirs(MODEL_DIR)
 
-def run_detailed_validation(rf, knn, processed_csv):
-    train_df = pd.read_csv(processed_csv).dropna()
-    X = train_df.drop('Price', axis=1).values.tolist()
-    y = train_df['Price'].values.tolist()
+def blend_predictions(p_rf, p_knn):
+    return RF_WEIGHT * p_rf + KNN_WEIGHT * p_knn
 
-    _, X_test, _, y_test = train_test_split(X, y, test_size=0.2)
+
+def predict_ensemble(rf, knn, features):
+    p_rf = rf.predict(features)
+    p_knn = knn.predict(features)
+    return p_rf, p_knn, blend_predictions(p_rf, p_knn)
+
+
+def predict_ensemble_range(rf, knn, features, quantiles=PRICE_RANGE_QUANTILES):
+    # predict_ensemble plus a price range from the same model passes: the quantiles over the trees and over the
+    # KNN neighbours, blended with the model weights into (rows x len(quantiles)), and the standard deviation of
+    # each model's spread. Every output has one entry per row, so PredictionCache can store them.
+    p_rf, q_rf, spread_rf = rf.predict_distribution(features, quantiles)
+    p_knn, q_knn, spread_knn = knn.predict_distribution(features, quantiles)
+    return (p_rf, p_knn, blend_predictions(p_rf, p_knn), blend_predictions(q_rf, q_knn),
+            spread_rf, spread_knn)
+
+
+def _encode(values, mapping):
+    codes = LabelEncoder.from_mapping(mapping).transform(values)
+    return np.where(codes == UNKNOWN, np.nan, codes)
+
+
+def build_features(listings, header, n_rows):
+    # Model input rows in training column order from n_rows listings given as columns (a DataFrame chunk or a dict
+    # of lists):
+    # Rooms, Area, Floor_Number, Total_Floors, Construction_Year, District, Construction_Type and FLAG_COLUMNS.
+    # Returns the matrix and a mask of the rows that are usable (every value present, known district and type).
+    # Only the FLAG_COLUMNS may be left out (they count as 0); without a required column no row is usable.
+    # Everything comes from the artifact header: the encoder vocabularies, and the room_area_breakpoints and
+    # median_year that fill rooms / construction years that are missing or not positive the way training did
+    # (without those statistics, from artifacts that predate them, such rows are not usable).
+    encoders = header['encoders']
+    median_year = header.get('median_year')
+    room_area_breakpoints = header.get('room_area_breakpoints')
+    n = n_rows
+
+    def column(name):
+        if name in listings:
+            return np.array(listings[name], dtype=np.float64)
+        return np.zeros(n) if name in FLAG_COLUMNS else np.full(n, np.nan)
+
+    def encoded(name):
+        if name in listings:
+            return _encode(listings[name], encoders[name])
+        return np.full(n, np.nan)
+
+    rooms = column('Rooms')
+    area = column('Area')
+    missing_rooms = np.isnan(rooms) | (rooms <= 0)
+    rooms[missing_rooms] = np.nan if room_area_breakpoints is None else \
+        rooms_by_area(area[missing_rooms], room_area_breakpoints)
+    year = column('Construction_Year')
+    year[year <= 0] = np.nan if median_year is None else median_year
+
+    floor = column('Floor_Number')
+    total_floors = column('Total_Floors')
+    is_first = (floor == 1).astype(np.float64)
+    is_last = ((total_floors > 0) & (floor == total_floors)).astype(np.float64)
+    flags = [column(name) for name in FLAG_COLUMNS]
+
+    X = np.column_stack([
+        rooms, area, floor, total_floors, year,
+        is_first, is_last,
+        flags[0], flags[1],
+        encoded('District'), encoded('Construction_Type'),
+    ] + flags[2:])
+    return X, ~np.isnan(X).any(axis=1)
+
+
+def load_training_data(processed_csv):
+    # The CSV is parsed once into a memory-mapped .npy cache that is rebuilt when the CSV or the processor config
+    # changes; the models get read-only views of it. Imported here: loading saved models for the GUI never needs it.
+    from data.training_cache import TrainingDataCache
+    return TrainingDataCache(processed_csv).load()
+
+
+def artifact_metadata(processed_csv):
+    # Feature order and encoder vocabularies are stored with the models so an artifact is self-describing
+    import pandas as pd
+    from data.data_processor import DISTRICT_AGGREGATES_FILE, PropertyProcessor
+    feature_names = [c for c in pd.read_csv(processed_csv, nrows=0).columns if c != 'Price']
+    encoders = {}
+    data_dir = os.path.dirname(os.path.abspath(processed_csv))
+    for column in ENCODED_COLUMNS:
+        encoder_path = os.path.join(data_dir, f'{column}_encoder.json')
+        if os.path.exists(encoder_path):
+            with open(encoder_path, 'r', encoding='utf-8') as f:
+                encoders[column] = json.load(f)['mapping']
+    metadata = {'feature_names': feature_names, 'encoders': encoders,
+                'median_year': training_median_year(processed_csv),
+                'room_area_breakpoints': PropertyProcessor().room_area_breakpoints}
+    aggregates_path = os.path.join(data_dir, DISTRICT_AGGREGATES_FILE)
+    if os.path.exists(aggregates_path):
+        with open(aggregates_path, 'r', encoding='utf-8') as f:
+            metadata['district_aggregates'] = json.load(f)
+    return metadata
+
+
+def training_median_year(processed_csv):
+    # Fills missing construction years of listings processed after training (see update_models)
+    from data.training_cache import TrainingDataCache
+    cache = TrainingDataCache(processed_csv)
+    X, _ = cache.load()
+    years = X[:, cache.feature_names.index('Construction_Year')]
+    return float(np.median(years[years > 0]))
+
+
+def data_split(split, n_rows):
+    # Row indices (into load_training_data) of the training rows and of the holdout. split is the boundary the
+    # artifact recorded when it was trained: the holdout stays the same rows after update_models appends listings,
+    # which are training rows like everything before the holdout. Artifacts without one get the last TEST_SIZE share.
+    if split is None:
+        n_train = int(n_rows * (1 - TEST_SIZE))
+        split = {'train_rows': n_train, 'holdout_rows': n_rows - n_train}
+    holdout_end = split['train_rows'] + split['holdout_rows']
+    train = np.concatenate((np.arange(split['train_rows']), np.arange(holdout_end, n_rows)))
+    return split, train, np.arange(split['train_rows'], holdout_end)
+
+
+def run_detailed_validation(rf, knn, processed_csv, split=None):
+    X, y = load_training_data(processed_csv)
+    _, train, holdout = data_split(split, len(X))
+    X_test, y_test = X[holdout], y[holdout]
 
     p_rf = rf.predict(X_test)
     p_knn = knn.predict(X_test)
 
     cart = CARTRegressor(max_depth=10)
 
-    X_train_temp, _, y_train_temp, _ = train_test_split(X, y, test_size=0.2)
-    cart.fit(X_train_temp, y_train_temp)
+    cart.fit(X[train], y[train])
     p_cart = cart.predict(X_test)
 
-    mae_rf, mape_rf = calculate_metrics(y_test, p_rf)
-    mae_knn, mape_knn = calculate_metrics(y_test, p_knn)
-    mae_cart, mape_cart = calculate_metrics(y_test, p_cart)
+    p_final = blend_predictions(p_rf, p_knn)
+
+    scores = {}
+    for name, predictions in (('rf', p_rf), ('knn', p_knn), ('cart', p_cart), ('ensemble', p_final)):
+        mae, mape = calculate_metrics(y_test, predictions)
+        scores[name] = {'mae': mae, 'mape': mape}
+    if rf.oob_metrics:
+        scores['rf_oob'] = rf.oob_metrics
 
-    p_final = [0.7 * p_rf[i] + 0.3 * p_knn[i] for i in range(len(y_test))]
-    mae_final, mape_final = calculate_metrics(y_test, p_final)
+    print_metrics(scores)
+    return scores
+
+
+def print_metrics(scores):
+    # Rows missing from scores are skipped: models trained without the validate command only have the OOB row
+    rows = [('rf_oob', 'Random Forest (OOB)'), ('rf', 'Random Forest'), ('knn', 'k-Nearest Neighbors'),
+            ('cart', 'CART (Decision Tree)')]
 
     print("\n" + "=" * 55)
     print(f"{'ALGORITHM':<25} | {'MAE (€)':<12} | {'ACCURACY (%)'}")
     print("-" * 55)
-    print(f"{'Random Forest':<25} | {mae_rf:>10.2f} | {100 - mape_rf:>11.2f}%")
-    print(f"{'k-Nearest Neighbors':<25} | {mae_knn:>10.2f} | {100 - mape_knn:>11.2f}%")
-    print(f"{'CART (Decision Tree)':<25} | {mae_cart:>10.2f} | {100 - mape_cart:>11.2f}%")
-    print("-" * 55)
-    print(f"{'FINAL HYBRID ENSEMBLE':<25} | {mae_final:>10.2f} | {100 - mape_final:>11.2f}%")
+    for key, label in rows:
+        if key in scores:
+            print(f"{label:<25} | {scores[key]['mae']:>10.2f} | {100 - scores[key]['mape']:>11.2f}%")
+    if 'ensemble' in scores:
+        print("-" * 55)
+        print(f"{'FINAL HYBRID ENSEMBLE':<25} | {scores['ensemble']['mae']:>10.2f} | {100 - scores['ensemble']['mape']:>11.2f}%")
     print("=" * 55 + "\n")
 
 
 def train_and_save_models(processed_csv):
     print("No saved models found. Training started...")
-    train_df = pd.read_csv(processed_csv).dropna()
-    X = train_df.drop('Price', axis=1).values.tolist()
-    y = train_df['Price'].values.tolist()
+    X, y = load_training_data(processed_csv)
 
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE)
 
-    rf = RandomForestRegressor(n_trees=15, max_depth=10)
+    rf = RandomForestRegressor(n_trees=15, max_depth=10, n_jobs=N_JOBS)
     rf.fit(X_train, y_train)
 
-    knn = KNN(k=15)
+    knn = KNN(k=15, precision=KNN_PRECISION, rerank=KNN_RERANK)
     knn.fit(X_train, y_train)
 
-    with open(RF_PATH, 'wb') as f: pickle.dump(rf, f)
-    with open(KNN_PATH, 'wb') as f: pickle.dump(knn, f)
-
-    run_detailed_validation(rf, knn, processed_csv)
+    # The forest's out-of-bag estimate comes out of fit; the validate command adds the full comparison table
+    scores = {'rf_oob': rf.oob_metrics}
+    print_metrics(scores)
+    split = {'train_rows': len(X_train), 'holdout_rows': len(X_test)}
+    save_artifact(MODEL_DIR, {'rf': rf, 'knn': knn}, metrics=scores, split=split, **artifact_metadata(processed_csv))
+    # Cached predictions belong to the models that were just replaced
+    invalidate_all()
     return rf, knn
 
 
-def load_trained_models(processed_csv):
-    if os.path.exists(RF_PATH) and os.path.exists(KNN_PATH):
-        print("Loading pre-trained models from disk...")
-        with open(RF_PATH, 'rb') as f:
-            rf = pickle.load(f)
-        with open(KNN_PATH, 'rb') as f:
-            knn = pickle.load(f)
+def update_models(delta_csv, processed_csv, n_replace=None):
+    # Incremental update from a CSV of newly scraped listings (raw scrape columns): they are processed with the
+    # encoders and median year stored in the artifact and appended to the KNN store. The trees that replace the
+    # oldest ones of the forest are trained on them plus the most recent ROLLING_WINDOW share of the training rows
+    # (never the holdout), so after many updates the forest is not made of trees that each saw one small delta.
+    # The processed rows are appended to processed_csv, after the holdout, for later full retrains.
+    import pandas as pd
+    from data.data_processor import PropertyProcessor
 
-        run_detailed_validation(rf, knn, processed_csv)
+    header, models = load_artifact(MODEL_DIR)
+    rf, knn = models['rf'], models['knn']
+    median_year = header.get('median_year')
+    if median_year is None:
+        median_year = training_median_year(processed_csv)
+
+    raw = pd.read_csv(delta_csv, sep=',', encoding='utf-8')
+    processor = PropertyProcessor()
+    delta = processor.process_delta(raw, header['encoders'], median_year).dropna()
+    if list(delta.columns[:-1]) != header['feature_names']:
+        raise ValueError(f"Processed columns {list(delta.columns[:-1])} do not match the model features")
+    print(f"Updating models with {len(delta)} of {len(raw)} new listings...")
+    if len(delta) == 0:
         return rf, knn
+
+    X_new = delta.drop(columns='Price').to_numpy(dtype=np.float64)
+    y_new = delta['Price'].to_numpy(dtype=np.float64)
+    knn.partial_fit(X_new, y_new)
+    X_old, y_old = load_training_data(processed_csv)
+    split, train, _ = data_split(header.get('split'), len(X_old))
+    window = train[len(train) - int(round(ROLLING_WINDOW * len(train))):]
+    rf.partial_fit(np.concatenate((X_old[window], X_new)), np.concatenate((y_old[window], y_new)), n_replace)
+
+    delta.to_csv(processed_csv, mode='a', header=False, index=False)
+    # The stored metrics describe the previous models; run the validate command for new ones
+    metadata = {key: header[key] for key in ('feature_names', 'encoders', 'district_aggregates') if key in header}
+    save_artifact(MODEL_DIR, {'rf': rf, 'knn': knn}, median_year=median_year, split=split,
+                  room_area_breakpoints=processor.room_area_breakpoints, **metadata)
+    invalidate_all()
+    return rf, knn
+
+
+def load_trained_models(processed_csv, validate=False):
+    # Fast path: the saved artifact is memory-mapped and the metrics recorded when it was validated are shown
+    # instead of re-running the validation; pass validate=True (or call validate_saved_models) to recompute them
+    with metrics.timer('app.load_trained_models'):
+        if artifact_exists(MODEL_DIR):
+            print("Loading pre-trained models from disk...")
+            header, models = load_artifact(MODEL_DIR)
+            rf, knn = models['rf'], models['knn']
+
+            if validate:
+                validate_saved_models(processed_csv, rf, knn)
+            elif header.get('metrics'):
+                print_metrics(header['metrics'])
+            else:
+                print("No stored validation metrics; run the validate command to compute them.")
+            return rf, knn
+        else:
+            return train_and_save_models(processed_csv)
+
+
+def validate_saved_models(processed_csv, rf=None, knn=None):
+    if rf is None or knn is None:
+        header, models = load_artifact(MODEL_DIR)
+        rf, knn = models['rf'], models['knn']
     else:
-        return train_and_save_models(processed_csv)
\ No newline at end of file
+        header = load_header(MODEL_DIR)
+    scores = run_detailed_validation(rf, knn, processed_csv, header.get('split'))
+    update_metadata(MODEL_DIR, metrics=scores)
+    return scores
@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+from collections import deque
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+import numpy as np
+import pandas as pd
+
+from src.app_logic import MODEL_DIR, build_features, blend_predictions, _encode
+from src.models.artifacts import load_artifact, load_header
+from src.utils.config import N_JOBS, PRICE_RANGE_QUANTILES
+from src.utils.workers import resolve_n_jobs, worker_pool, worker_state
+
+CHUNK_SIZE = 50000
+
+def _load_models(model_dir):
+    # Models of a worker process; every worker memory-maps the same artifact files
+    return load_artifact(model_dir)[1]
+
+def _predict_in_worker(features, quantiles):
+    return predict_batch(worker_state(), features, quantiles)
+
+def predict_batch(models, features, quantiles=None):
+    # With quantiles, the same passes also return the blended price range and the spread of each model
+    if quantiles is None:
+        return models['rf'].predict(features), models['knn'].predict(features)
+    p_rf, q_rf, spread_rf = models['rf'].predict_distribution(features, quantiles)
+    p_knn, q_knn, spread_knn = models['knn'].predict_distribution(features, quantiles)
+    return p_rf, p_knn, blend_predictions(q_rf, q_knn), spread_rf, spread_knn
+
+def _district_tables(aggregates, mapping):
+    # Output column -> array indexed by the district code of the encoder. Aligned by district name, so a table
+    # from another vocabulary cannot shift the join; districts without priced listings are NaN.
+    n_codes = max(mapping.values(), default=-1) + 1
+    tables = {}
+    for name, field in (('District_Price_per_m2', 'median_price_per_m2'), ('District_Listings', 'count')):
+        table = np.full(n_codes, np.nan)
+        for district, value in zip(aggregates['districts'], aggregates[field]):
+            if district in mapping and value is not None:
+                table[mapping[district]] = value
+        tables[name] = table
+    return tables
+
+def _district_columns(chunk, encoders, tables):
+    # District context from the table built by process_data: one array lookup per row by the district code.
+    # Unknown districts stay empty.
+    codes = _encode(chunk['District'], encoders['District'])
+    known = ~np.isnan(codes)
+    columns = {}
+    for name, table in tables.items():
+        values = np.full(len(chunk), np.nan)
+        values[known] = table[codes[known].astype(np.int64)]
+        columns[name] = values
+    return columns
+
+def _range_columns(n_rows, valid, quantiles, p_range, spread_rf, spread_knn):
+    # Price_P10, Price_P90, ... per quantile and the standard deviations over the trees / the KNN neighbours
+    outputs = [(f'Price_P{q * 100:g}', p_range[:, i]) for i, q in enumerate(quantiles)]
+    outputs += [('RF_Spread', spread_rf), ('KNN_Spread', spread_knn)]
+    columns = {}
+    for name, values in outputs:
+        column = np.full(n_rows, np.nan)
+        column[valid] = values
+        columns[name] = column.round(2)
+    return columns
+
+def _write_chunk(chunk, valid, p_rf, p_knn, output_path, first, extra_columns=None):
+    # Rows that cannot be valued (missing values, unknown district or construction type) keep empty prices
+    rf_prices = np.full(len(chunk), np.nan)
+    knn_prices = np.full(len(chunk), np.nan)
+    rf_prices[valid] = p_rf
+    knn_prices[valid] = p_knn
+    chunk['RF_Price'] = rf_prices.round(2)
+    chunk['KNN_Price'] = knn_prices.round(2)
+    chunk['Estimated_Price'] = blend_predictions(rf_prices, knn_prices).round(2)
+    for name, values in (extra_columns or {}).items():
+        chunk[name] = values
+    chunk.to_csv(output_path, index=False, mode='w' if first else 'a', header=first)
+
+def value_listings(input_path, output_path, model_dir=MODEL_DIR, chunksize=CHUNK_SIZE, n_jobs=N_JOBS,
+                   quantiles=None):
+    # Streams the listings through build_features in chunks and appends each valued chunk to the output in input
+    # order. At most two chunks per worker are in flight, so memory depends on the chunk size, not the file size.
+    # quantiles (e.g. PRICE_RANGE_QUANTILES) adds the price range columns of _range_columns.
+    header = load_header(model_dir)
+    encoders = header['encoders']
+    # Artifacts trained before the aggregates table existed have none; their output keeps the price columns only
+    aggregates = header.get('district_aggregates')
+    tables = _district_tables(aggregates, encoders['District']) if aggregates is not None else None
+    chunks = pd.read_csv(input_path, sep=',', encoding='utf-8', chunksize=chunksize,
+                         dtype={'District': str, 'Construction_Type': str})
+    # A file of fewer chunks than workers starts one worker per chunk
+    n_workers = resolve_n_jobs(n_jobs)
+    first_chunks = list(itertools.islice(chunks, n_workers))
+    n_workers = resolve_n_jobs(n_workers, len(first_chunks))
+    chunks = itertools.chain(first_chunks, chunks)
+    n_rows = n_valued = 0
+
+    def write(chunk, valid, p_rf, p_knn, *spread):
+        nonlocal n_rows, n_valued
+        extra_columns = {}
+        if spread:
+            extra_columns.update(_range_columns(len(chunk), valid, quantiles, *spread))
+        if tables is not None:
+            extra_columns.update(_district_columns(chunk, encoders, tables))
+        _write_chunk(chunk, valid, p_rf, p_knn, output_path, n_rows == 0, extra_columns)
+        n_rows += len(chunk)
+        n_valued += int(valid.sum())
+
+    if n_workers == 1:
+        models = _load_models(model_dir)
+        for chunk in chunks:
+            features, valid = build_features(chunk, header, len(chunk))
+            write(chunk, valid, *predict_batch(models, features[valid], quantiles))
+    else:
+        pending = deque()
+        with worker_pool(n_workers, _load_models, model_dir) as pool:
+            for chunk in chunks:
+                features, valid = build_features(chunk, header, len(chunk))
+                pending.append((chunk, valid, pool.submit(_predict_in_worker, features[valid], quantiles)))
+                if len(pending) >= 2 * n_workers:
+                    chunk, valid, future = pending.popleft()
+                    write(chunk, valid, *future.result())
+            while pending:
+                chunk, valid, future = pending.popleft()
+                write(chunk, valid, *future.result())
+
+    return n_rows, n_valued
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Values every listing of a CSV file with the saved models")
+    parser.add_argument('input', help="CSV with Rooms, Area, Floor_Number, Total_Floors, Construction_Year, District, "
+                                      "Construction_Type and optional 0/1 columns Has_Garage, Is_Closed_Complex, "
+                                      "ext_has_gas, ext_has_tep, ext_is_luxury, ext_is_act16")
+    parser.add_argument('output', help="input columns plus RF_Price, KNN_Price, Estimated_Price and (when the model "
+                                       "has them) District_Price_per_m2 and District_Listings")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--n-jobs', type=int, default=N_JOBS)
+    parser.add_argument('--range', action='store_true',
+                        help=f"add Price_P* columns at the {PRICE_RANGE_QUANTILES} quantiles and RF_Spread / KNN_Spread")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_rows, n_valued = value_listings(args.input, args.output, chunksize=args.chunksize, n_jobs=args.n_jobs,
+                                      quantiles=PRICE_RANGE_QUANTILES if args.range else None)
+    print(f"Valued {n_valued} of {n_rows} listings in {time.perf_counter() - start:.1f} s -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
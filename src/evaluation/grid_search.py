@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import argparse
+import itertools
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from src.evaluation.cross_validation import fold_bounds, fold_score, shared_orders
+from src.utils.config import N_JOBS
+from src.utils.shared_arrays import share_arrays, attach_arrays, release_arrays
+from src.utils.workers import resolve_n_jobs, worker_pool, worker_state
+from src.utils.utils import as_float_array
+
+def _run_job(model_class, params, start, end, X, y, orders, nested_jobs):
+    if not nested_jobs and 'n_jobs' in params:
+        # The sweep already uses every worker; a forest inside a job trains its trees in that job's process
+        params = dict(params, n_jobs=1)
+    return fold_score(model_class, params, X, y, start, end, orders)
+
+def _run_job_in_worker(model_class, params, start, end):
+    # X, y and optionally the presorted orders, attached once per worker
+    X, y, *orders = worker_state()
+    return _run_job(model_class, params, start, end, X, y, orders[0] if orders else None, False)
+
+def parameter_grid(param_grid):
+    # {'max_depth': [6, 8], 'n_trees': [10]} -> [{'max_depth': 6, 'n_trees': 10}, {'max_depth': 8, 'n_trees': 10}]
+    keys = sorted(param_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(param_grid[key] for key in keys))]
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def data_fingerprint(X, y):
+    # Content hash of the training data, so a log is only resumed for the data its scores were computed on
+    digest = hashlib.sha256()
+    for array in (X, y):
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()[:16]
+
+def _read_log(log_path, run):
+    # Scores already in the log for this model, data and number of folds: {(params key, fold): score}
+    done = {}
+    if log_path is None or not os.path.exists(log_path):
+        return done
+    n_other_data = 0
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by an interrupted run
+            if all(entry.get(key) == value for key, value in run.items()):
+                done[(_params_key(entry['params']), entry['fold'])] = entry['score']
+            elif entry.get('model') == run['model'] and entry.get('data') != run['data']:
+                n_other_data += 1
+    if n_other_data:
+        print(f"{log_path}: ignoring {n_other_data} {run['model']} scores computed on other data")
+    return done
+
+def _open_log(log_path):
+    log = open(log_path, 'a+', encoding='utf-8')
+    if log.tell() > 0:
+        log.seek(log.tell() - 1)
+        if log.read(1) != '\n':
+            log.write('\n')  # Starts after a line an interrupted run left unfinished
+    return log
+
+def grid_search(model_class, X, y, param_grid, folds=10, n_jobs=N_JOBS, log_path=None):
+    # Cross-validates every parameter combination. Each (combination, fold) pair is one job in a process pool over
+    # shared read-only copies of X, y and the presorted feature orders; finished jobs are appended to log_path
+    # (JSON lines), so running the same sweep again only trains what is missing.
+    X = as_float_array(X)
+    y = np.asarray(y, dtype=np.float64)
+
+    candidates = parameter_grid(param_grid)
+    bounds = fold_bounds(len(X), folds)
+    run = {'model': model_class.__name__, 'n_samples': len(X), 'folds': folds, 'data': data_fingerprint(X, y)}
+    scores = _read_log(log_path, run)
+    jobs = [(_params_key(params), params, fold) for params in candidates for fold in range(folds)
+            if (_params_key(params), fold) not in scores]
+
+    if jobs:
+        orders = shared_orders(model_class, X)
+        log = _open_log(log_path) if log_path else None
+        try:
+            def record(key, params, fold, score):
+                scores[(key, fold)] = score
+                if log:
+                    log.write(json.dumps(dict(run, params=params, fold=fold, score=score)) + '\n')
+                    log.flush()
+
+            n_workers = resolve_n_jobs(n_jobs, len(jobs))
+            if n_workers == 1:
+                for key, params, fold in jobs:
+                    record(key, params, fold, _run_job(model_class, params, *bounds[fold], X, y, orders, True))
+            else:
+                blocks, handles = share_arrays(X, y, *(() if orders is None else (orders,)))
+                try:
+                    with worker_pool(n_workers, attach_arrays, handles) as pool:
+                        futures = {pool.submit(_run_job_in_worker, model_class, params, *bounds[fold]): (key, params, fold)
+                                   for key, params, fold in jobs}
+                        for future in as_completed(futures):
+                            record(*futures[future], future.result())
+                finally:
+                    release_arrays(blocks)
+        finally:
+            if log:
+                log.close()
+
+    results = []
+    for params in candidates:
+        fold_scores = [scores[(_params_key(params), fold)] for fold in range(folds)]
+        results.append({'params': params, 'mean_score': float(np.mean(fold_scores)), 'scores': fold_scores})
+    # Best (highest accuracy) first
+    return sorted(results, key=lambda result: -result['mean_score'])
+
+
+if __name__ == "__main__":
+    from src.app_logic import load_training_data
+    from src.models.knn import KNN
+    from src.models.random_forest import RandomForestRegressor
+
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    PROCESSED_CSV = os.path.join(BASE_DIR, '..', '..', 'data', 'final_training_data.csv')
+    GRIDS = {
+        'rf': (RandomForestRegressor, {'n_trees': [10, 15, 25], 'max_depth': [6, 8, 10, 12]}),
+        'knn': (KNN, {'k': [5, 10, 15, 20, 30]}),
+    }
+
+    parser = argparse.ArgumentParser(description="Cross-validated hyperparameter sweep")
+    parser.add_argument('model', choices=sorted(GRIDS))
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--n-jobs', type=int, default=N_JOBS)
+    parser.add_argument('--log', default=None, help="JSON-lines log; an interrupted sweep resumes from it")
+    args = parser.parse_args()
+
+    X, y = load_training_data(PROCESSED_CSV)
+    model_class, param_grid = GRIDS[args.model]
+    for result in grid_search(model_class, X, y, param_grid, folds=args.folds, n_jobs=args.n_jobs, log_path=args.log):
+        print(f"{result['mean_score']:>8.2f}%  {result['params']}")
@@ -1,22 +1,29 @@
 import os
 import sys
+import atexit
+import argparse
+import threading
 import tkinter as tk
 from tkinter import ttk
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
 
-from data.data_processor import PropertyProcessor
-from data.label_encoder import LabelEncoder
-from app_logic import load_trained_models
+from app_logic import MODEL_DIR, load_trained_models, validate_saved_models, update_models, build_features, predict_ensemble_range
+from src.models.artifacts import load_header
+from src.utils.prediction_cache import PredictionCache
+from src.utils.instrumentation import metrics
 
 INPUT_CSV = os.path.join(BASE_DIR, '..', 'data', 'estates_raw_data.csv')
 PROCESSED_CSV = os.path.join(BASE_DIR, '..', 'data', 'final_training_data.csv')
 
 model_rf = None
 model_knn = None
-district_encoder = None
-construction_encoder = None
+artifact_id = None
+# Encoder vocabularies and training statistics of the loaded artifact, the same ones the server and batch tool use
+header = None
+# Re-clicks and repeated listings are answered without running the models again
+prediction_cache = PredictionCache(max_size=1000)
 
 
 def calculate_price():
@@ -28,54 +35,55 @@ def calculate_price():
         total_floors = int(total_floors_entry.get())
         year = int(year_entry.get())
 
-        dist_val = district_encoder.transform([district_var.get()])[0]
-        const_val = construction_encoder.transform([construction_var.get()])[0]
-
-        is_first = 1 if floor == 1 else 0
-        is_last = 1 if (total_floors > 0 and floor == total_floors) else 0
-
-        features_list = [
-            rooms, area, floor, total_floors, year,
-            is_first, is_last,
-            1 if garage_var.get() else 0,
-            1 if closed_complex_var.get() else 0,
-            dist_val, const_val,
-            1 if gas_var.get() else 0,
-            1 if tep_var.get() else 0,
-            1 if luxury_var.get() else 0,
-            1 if act16_var.get() else 0
-        ]
-
-        res_rf = model_rf.predict([features_list])
-        pred_rf = res_rf[0] if isinstance(res_rf, list) else res_rf
-
-        res_knn = model_knn.predict([features_list])[0]
-
-        final_price = 0.3 * res_knn + 0.7 * pred_rf
+        listing = {
+            'Rooms': [rooms], 'Area': [area], 'Floor_Number': [floor], 'Total_Floors': [total_floors],
+            'Construction_Year': [year],
+            'District': [district_var.get()], 'Construction_Type': [construction_var.get()],
+            'Has_Garage': [1 if garage_var.get() else 0],
+            'Is_Closed_Complex': [1 if closed_complex_var.get() else 0],
+            'ext_has_gas': [1 if gas_var.get() else 0],
+            'ext_has_tep': [1 if tep_var.get() else 0],
+            'ext_is_luxury': [1 if luxury_var.get() else 0],
+            'ext_is_act16': [1 if act16_var.get() else 0]
+        }
+        features, valid = build_features(listing, header, 1)
+        if not valid[0]:
+            raise ValueError("unknown district or construction type")
+
+        p_rf, p_knn, p_final, p_range, _, _ = prediction_cache.predict(
+            features, artifact_id, lambda rows: predict_ensemble_range(model_rf, model_knn, rows))
+        pred_rf, res_knn, final_price = p_rf[0], p_knn[0], p_final[0]
+        low, high = p_range[0][0], p_range[0][-1]
 
         result_label.config(text=f"{final_price:,.0f} €", fg="#27ae60")
-        print(f"Prediction: RF={pred_rf:,.0f} | KNN={res_knn:,.0f} | Final={final_price:,.0f}")
+        range_label.config(text=f"{low:,.0f} – {high:,.0f} €")
+        print(f"Prediction: RF={pred_rf:,.0f} | KNN={res_knn:,.0f} | Final={final_price:,.0f} | "
+              f"Range={low:,.0f}-{high:,.0f}")
 
     except Exception as e:
         print(f"Error in calculation: {e}")
         result_label.config(text="Грешка в данните", fg="#e74c3c")
+        range_label.config(text="")
 
 
-def start_app():
-    global model_rf, model_knn, district_encoder, construction_encoder
-    global rooms_entry, area_entry, floor_entry, total_floors_entry, year_entry
-    global district_var, construction_var, garage_var, closed_complex_var
-    global gas_var, tep_var, luxury_var, act16_var, result_label
-
-    processor = PropertyProcessor()
+def ensure_processed_data():
     if not os.path.exists(PROCESSED_CSV):
+        # Imported lazily: the processor pulls in pandas, which is only needed when the CSV has to be built
+        from data.data_processor import PropertyProcessor
         print("Initial data processing...")
-        processor.process_data(INPUT_CSV, PROCESSED_CSV)
+        PropertyProcessor().process_data(INPUT_CSV, PROCESSED_CSV)
 
-    model_rf, model_knn = load_trained_models(PROCESSED_CSV)
 
-    district_encoder = LabelEncoder().load(os.path.join(BASE_DIR, '..', 'data', 'District_encoder.json'))
-    construction_encoder = LabelEncoder().load(os.path.join(BASE_DIR, '..', 'data', 'Construction_Type_encoder.json'))
+def start_app(validate_in_background=False):
+    global model_rf, model_knn, header, artifact_id
+    global rooms_entry, area_entry, floor_entry, total_floors_entry, year_entry
+    global district_var, construction_var, garage_var, closed_complex_var
+    global gas_var, tep_var, luxury_var, act16_var, result_label, range_label
+
+    ensure_processed_data()
+    model_rf, model_knn = load_trained_models(PROCESSED_CSV)
+    header = load_header(MODEL_DIR)
+    artifact_id = header['artifact_id']
 
     root = tk.Tk()
     root.title("Интелигентна Оценка на Имоти")
@@ -106,10 +114,10 @@ def start_app():
 
     loc_frame = tk.LabelFrame(main_container, text=" Локация и Тип ", bg="white", padx=15, pady=15)
     loc_frame.pack(fill="x", pady=10)
-    districts = sorted(list(district_encoder.mapping.keys()))
+    districts = sorted(list(header['encoders']['District'].keys()))
     district_var = tk.StringVar(value=districts[0])
     ttk.Combobox(loc_frame, textvariable=district_var, values=districts, state="readonly").pack(fill="x", pady=5)
-    const_types = sorted(list(construction_encoder.mapping.keys()))
+    const_types = sorted(list(header['encoders']['Construction_Type'].keys()))
     construction_var = tk.StringVar(value=const_types[0])
     ttk.Combobox(loc_frame, textvariable=construction_var, values=const_types, state="readonly").pack(fill="x", pady=5)
 
@@ -135,8 +143,44 @@ def start_app():
     res_frame.pack(fill="x")
     result_label = tk.Label(res_frame, text="--- €", font=("Helvetica", 24, "bold"), bg="#e7f3ff", fg="#1877f2")
     result_label.pack()
+    range_label = tk.Label(res_frame, text="", font=("Helvetica", 12), bg="#e7f3ff", fg="#555555")
+    range_label.pack()
+
+    if validate_in_background:
+        threading.Thread(target=validate_saved_models, args=(PROCESSED_CSV, model_rf, model_knn), daemon=True).start()
 
     root.mainloop()
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Estate price estimation")
+    parser.add_argument('command', nargs='?', choices=['gui', 'validate', 'update'], default='gui',
+                        help="'validate' re-runs the validation of the saved models and stores the metrics; "
+                             "'update' adds the listings of a delta CSV to the saved models")
+    parser.add_argument('delta', nargs='?', help="raw CSV of new listings for the 'update' command")
+    parser.add_argument('--replace-trees', type=int, default=None,
+                        help="oldest forest trees replaced by an update (default: a fifth of the forest)")
+    parser.add_argument('--validate', action='store_true',
+                        help="re-run the validation in the background while the GUI is open")
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help="record stage timers and counters and write them on exit "
+                             "(Prometheus text for .prom / .txt, JSON otherwise)")
+    args = parser.parse_args()
+
+    if args.profile:
+        metrics.enable()
+        atexit.register(metrics.write, args.profile)
+
+    if args.command == 'validate':
+        ensure_processed_data()
+        validate_saved_models(PROCESSED_CSV)
+    elif args.command == 'update':
+        if not args.delta:
+            parser.error("update needs the path of a delta CSV")
+        ensure_processed_data()
+        update_models(args.delta, PROCESSED_CSV, args.replace_trees)
+    else:
+        start_app(validate_in_background=args.validate)
+
 if __name__ == "__main__":
-    start_app()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from src.models.knn import KNN
+from src.models.random_forest import RandomForestRegressor
+from src.utils.instrumentation import metrics
+
+# Bump when the header layout or the array set of a model class changes. Version 1 kept the arrays next to the
+# header; from version 2 every saved version has its own directory of arrays, named by its artifact id.
+FORMAT_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+HEADER_FILE = 'header.json'
+# A reader that picked up a header just before a save removed its arrays reads the new header again
+LOAD_ATTEMPTS = 3
+MODEL_CLASSES = {cls.__name__: cls for cls in (RandomForestRegressor, KNN)}
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def _array_path(directory, model_name, array_name):
+    return os.path.join(directory, f'{model_name}.{array_name}.npy')
+
+
+def _arrays_dir(directory, header):
+    return os.path.join(directory, header.get('arrays_dir', ''))
+
+
+def artifact_exists(directory):
+    return os.path.exists(os.path.join(directory, HEADER_FILE))
+
+
+def save_artifact(directory, models, **metadata):
+    # models maps a name to a fitted model; metadata (feature order, encoders, ...) goes into the header.
+    # The arrays go into a new directory named by the artifact id and the header, which points at it, is replaced
+    # in one rename: a reader sees either the previous version or this one, never a mix of their arrays.
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    header = {'format_version': FORMAT_VERSION, 'models': {}}
+    header.update(metadata)
+
+    staging = tempfile.mkdtemp(prefix='.saving-', dir=directory)
+    try:
+        for model_name, model in models.items():
+            params, arrays = model.to_arrays()
+            for array_name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                with open(_array_path(staging, model_name, array_name), 'wb') as f:
+                    np.save(f, array)
+                digest.update(array.tobytes())
+            digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+            header['models'][model_name] = {'class': type(model).__name__, 'params': params, 'arrays': sorted(arrays)}
+
+        header['artifact_id'] = digest.hexdigest()[:16]
+        header['arrays_dir'] = header['artifact_id']
+        target = os.path.join(directory, header['arrays_dir'])
+        if os.path.isdir(target):
+            # Same arrays as a version already on disk (e.g. saved again with new metadata): that one is kept
+            shutil.rmtree(staging)
+        else:
+            os.rename(staging, target)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    _write_header(directory, header)
+    _remove_old_versions(directory, header['arrays_dir'])
+    return header
+
+
+def _remove_old_versions(directory, current):
+    # Processes that still map files of an older version keep reading them: removing only drops the names
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == current or name.startswith('.saving-'):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.endswith('.npy'):
+            # Arrays of the version 1 layout
+            os.remove(path)
+
+
+def _write_header(directory, header):
+    header_path = os.path.join(directory, HEADER_FILE)
+    with open(header_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(header, f, ensure_ascii=False, indent=2)
+    os.replace(header_path + '.tmp', header_path)
+
+
+def update_metadata(directory, **metadata):
+    # Rewrites only the header (e.g. metrics from a later validation run); the model arrays stay as they are
+    header = load_header(directory)
+    header.update(metadata)
+    _write_header(directory, header)
+    return header
+
+
+def load_header(directory):
+    with open(os.path.join(directory, HEADER_FILE), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header.get('format_version') not in READABLE_VERSIONS:
+        raise ArtifactError(f"Unsupported model artifact version {header.get('format_version')} in {directory}")
+    return header
+
+
+def load_artifact(directory, mmap_mode='r'):
+    # Arrays are memory-mapped read-only by default: loading costs the same for any training-set size
+    # and processes that load the same artifact share one copy through the page cache
+    with metrics.timer('artifact.load'):
+        for attempt in range(LOAD_ATTEMPTS):
+            header = load_header(directory)
+            try:
+                return header, _load_models(directory, header, mmap_mode)
+            except FileNotFoundError:
+                # A save replaced the header and removed these arrays between the two reads
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+
+def _load_models(directory, header, mmap_mode):
+    arrays_dir = _arrays_dir(directory, header)
+    models = {}
+    for model_name, entry in header['models'].items():
+        if entry['class'] not in MODEL_CLASSES:
+            raise ArtifactError(f"Unknown model class {entry['class']} in {directory}")
+        arrays = {name: np.load(_array_path(arrays_dir, model_name, name), mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in entry['arrays']}
+        models[model_name] = MODEL_CLASSES[entry['class']].from_arrays(entry['params'], arrays)
+    return models
@@ -1,6 +1,27 @@
-from src.utils.config  import MAX_DEPTH, MIN_SAMPLES_SPLIT
+import heapq
+
+import numpy as np
+
+from src.utils.config import MAX_DEPTH, MIN_SAMPLES_SPLIT, MAX_BINS, RANDOM_SEED
+from src.utils.instrumentation import metrics
+from src.utils.utils import as_float_array
+
+# Running sums round differently from per-subset sums, so scores this close (relative to the node's
+# variance, plus the rounding error of summing squares) count as ties and the first candidate wins.
+TIE_TOLERANCE = 1e-9
+ROUNDING_TOLERANCE = 1e-13
+
+def presort(X):
+    # Row ids of X sorted by each feature. Computed once, it serves every subset of X through subset_orders.
+    return np.stack([np.argsort(X[:, f], kind='stable') for f in range(X.shape[1])])
+
+def subset_orders(orders, counts):
+    # Narrows presort(X) to a multiset of rows in O(n): counts[row] is 0 for rows left out (another CV fold)
+    # and above 1 for rows a bootstrap drew several times
+    return np.stack([np.repeat(order, counts[order]) for order in orders])
 
 class TreeNode:
+    # Linked representation used by models pickled before TreeArrays; only read when converting them
     def __init__(self, feature_index=None, threshold=None, left=None, right=None, value=None):
         self.feature_index = feature_index
         self.threshold = threshold
@@ -8,85 +29,364 @@ class TreeNode:
         self.right = right
         self.value = value
 
+class TreeArrays:
+    # Parallel arrays indexed by node id. Leaves have left == right == -1; value holds each node's mean
+    # (NaN on the internal nodes of trees converted from TreeNode, which never stored it).
+    FIELDS = ('feature_index', 'threshold', 'left', 'right', 'value')
+
+    def __init__(self, feature_index, threshold, left, right, value):
+        self.feature_index = np.asarray(feature_index, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.value)
+
+    def to_arrays(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_node(cls, root):
+        feature_index, threshold, left, right, value = [], [], [], [], []
+        stack = [(root, -1, False)]
+        while stack:
+            node, parent, is_left = stack.pop()
+            node_id = len(value)
+            if parent >= 0:
+                (left if is_left else right)[parent] = node_id
+
+            is_leaf = node.value is not None
+            feature_index.append(-1 if is_leaf else node.feature_index)
+            threshold.append(0.0 if is_leaf else node.threshold)
+            left.append(-1)
+            right.append(-1)
+            value.append(node.value if is_leaf else np.nan)
+            if not is_leaf:
+                stack.append((node.right, node_id, False))
+                stack.append((node.left, node_id, True))
+        return cls(feature_index, threshold, left, right, value)
+
+    @classmethod
+    def concatenate(cls, trees):
+        # One node table for several trees; returns it with the node id of each tree's root
+        offsets = np.cumsum([0] + [len(tree) for tree in trees[:-1]])
+
+        def shifted(children, offset):
+            return np.where(children >= 0, children + offset, -1)
+
+        combined = cls(
+            np.concatenate([tree.feature_index for tree in trees]),
+            np.concatenate([tree.threshold for tree in trees]),
+            np.concatenate([shifted(tree.left, offset) for tree, offset in zip(trees, offsets)]),
+            np.concatenate([shifted(tree.right, offset) for tree, offset in zip(trees, offsets)]),
+            np.concatenate([tree.value for tree in trees]))
+        return combined, offsets
+
+    def apply(self, X, nodes):
+        # Moves every (sample, start node) pair one level down per pass until all of them reach a leaf.
+        # nodes may have any shape whose last axis runs over the rows of X.
+        nodes = np.array(nodes, dtype=np.intp)
+        flat = nodes.reshape(-1)
+        rows = np.broadcast_to(np.arange(len(X)), nodes.shape).reshape(-1)
+
+        active = np.flatnonzero(self.left[flat] >= 0)
+        while len(active):
+            current = flat[active]
+            goes_left = X[rows[active], self.feature_index[current]] <= self.threshold[current]
+            flat[active] = np.where(goes_left, self.left[current], self.right[current])
+            active = active[self.left[flat[active]] >= 0]
+        return nodes
+
+    def predict(self, X):
+        return self.value[self.apply(X, np.zeros(len(X), dtype=np.intp))]
+
 class CARTRegressor:
-    def __init__(self, max_depth=MAX_DEPTH, min_samples_split=MIN_SAMPLES_SPLIT):
+    def __init__(self, max_depth=MAX_DEPTH, min_samples_split=MIN_SAMPLES_SPLIT, max_bins=MAX_BINS,
+                 max_features=None, min_samples_leaf=1, min_impurity_decrease=0.0, max_leaf_nodes=None,
+                 random_state=RANDOM_SEED):
         self.max_depth = max_depth
         self.min_samples_split = min_samples_split
-        self.root = None
+        # None -> exact search over every midpoint; an int -> quantile histogram with at most max_bins buckets
+        self.max_bins = max_bins
+        # Features drawn for each split: None (all), 'sqrt', 'log2', a fraction in (0, 1] or a count
+        self.max_features = max_features
+        self.min_samples_leaf = min_samples_leaf
+        # A node is only split if it lowers the squared error, weighted by the node's share of the rows, this much
+        self.min_impurity_decrease = min_impurity_decrease
+        # None grows depth-first; a number grows best-first (largest error decrease next) up to that many leaves
+        self.max_leaf_nodes = max_leaf_nodes
+        # Seed or np.random.Generator of the feature draws; unused while max_features is None
+        self.random_state = random_state
+        self.tree = None
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+        root = self.__dict__.pop('root', None)
+        if root is not None:
+            self.tree = TreeArrays.from_node(root)
 
     def predict(self, X):
-        y_pred = [self._predict_sample(self.root, x) for x in X]
-        return y_pred
+        return self.tree.predict(as_float_array(X))
 
     def fit(self, X, y):
-        self.root = self._build_tree(X, y, depth=0)
-
-    def _mse(self, y):
-        if len(y) == 0:
-            return 0
-        mean_y = sum(y) / len(y)
-        return sum((yi - mean_y) ** 2 for yi in y) / len(y)
-
-    def _split_dataset(self, X, y, feature_index, threshold):
-        left_X, right_X, left_y, right_y = [], [], [], []
-        for i in range(len(X)):
-            if X[i][feature_index] <= threshold:
-                left_X.append(X[i])
-                left_y.append(y[i])
+        X = as_float_array(X)
+        y = np.asarray(y, dtype=np.float64)
+        self._fit_rows(X, y, np.arange(len(X)))
+
+    def _fit_rows(self, X, y, rows, orders=None):
+        # rows index into X and y (repeats allowed for bootstrap samples), so the data itself is never copied.
+        # orders may be presort(X), shared by every tree and fold fitted on the same X.
+        n_features = X.shape[1]
+        self._goes_left = np.zeros(len(X), dtype=bool)
+        self._n_split_features = self._resolve_max_features(n_features)
+        self._rng = np.random.default_rng(self.random_state) if self._n_split_features < n_features else None
+
+        with metrics.timer('cart.sort_features'):
+            if self.max_bins:
+                self._bin_edges = [self._quantile_tresholds(X[rows, f]) for f in range(n_features)]
+                self._bins = np.column_stack([np.searchsorted(edges, X[:, f])
+                                              for f, edges in enumerate(self._bin_edges)])
+                orders = None
+            elif orders is None:
+                # Each feature is sorted once; children inherit their order by stable partitioning.
+                orders = np.stack([rows[np.argsort(X[rows, f], kind='stable')] for f in range(n_features)])
             else:
-                right_X.append(X[i])
-                right_y.append(y[i])
-        return left_X, right_X, left_y, right_y
+                orders = subset_orders(orders, np.bincount(rows, minlength=len(X)))
+        with metrics.timer('cart.build_tree'):
+            self.tree = self._build_tree(X, y, rows, orders)
+
+        self._goes_left = None
+        self._bin_edges = None
+        self._bins = None
+        self._rng = None
+        self._n_root = None
+
+    def _resolve_max_features(self, n_features):
+        if self.max_features is None:
+            return n_features
+        if self.max_features == 'sqrt':
+            count = int(np.sqrt(n_features))
+        elif self.max_features == 'log2':
+            count = int(np.log2(n_features))
+        elif isinstance(self.max_features, float):
+            if not 0 < self.max_features <= 1:
+                raise ValueError(f"max_features fraction must be in (0, 1], got {self.max_features}")
+            count = int(self.max_features * n_features)
+        elif isinstance(self.max_features, (int, np.integer)):
+            count = self.max_features
+        else:
+            raise ValueError(f"max_features must be None, 'sqrt', 'log2', a fraction or a count, "
+                             f"got {self.max_features!r}")
+        return min(max(1, count), n_features)
+
+    def _split_features(self, n_features):
+        # Feature ids searched at one node, ascending so equal scores still go to the lowest feature
+        if self._rng is None:
+            return range(n_features)
+        return np.sort(self._rng.choice(n_features, self._n_split_features, replace=False))
 
     def _possible_tresholds(self, values):
-        sorted_values = sorted(set(values))
-        thresholds = []
-        for i in range(len(sorted_values) - 1):
-            thresholds.append((sorted_values[i] + sorted_values[i + 1]) / 2)
-        return thresholds
+        sorted_values = np.unique(values)
+        return (sorted_values[:-1] + sorted_values[1:]) / 2
+
+    def _quantile_tresholds(self, values):
+        thresholds = self._possible_tresholds(values)
+        if len(thresholds) < self.max_bins:
+            return thresholds
+
+        sorted_values = np.sort(values)
+        n = len(sorted_values)
+        quantiles = sorted_values[np.arange(1, self.max_bins) * n // self.max_bins]
+        positions = np.searchsorted(thresholds, quantiles)
+        return np.unique(thresholds[positions[positions < len(thresholds)]])
+
+    def _split_score(self, left_n, left_sum, left_sq, total_n, total_sum, total_sq):
+        right_n = total_n - left_n
+        right_sum = total_sum - left_sum
+        right_sq = total_sq - left_sq
+        left_sse = left_sq - left_sum * left_sum / left_n
+        right_sse = right_sq - right_sum * right_sum / right_n
+        return (left_sse + right_sse) / total_n
+
+    def _tie_tolerance(self, n, total_sum, total_sq):
+        node_sse = max(total_sq - total_sum * total_sum / n, 0)
+        return (TIE_TOLERANCE * node_sse + ROUNDING_TOLERANCE * total_sq) / n
 
-    def _best_split(self, X, y):
+    def _first_best(self, scores, tolerance):
+        best = scores.min() if len(scores) else np.inf
+        if not np.isfinite(best):
+            return None, np.inf
+        return int(np.argmax(scores <= best + tolerance)), float(best)
+
+    def _node_error(self, n, total_sum, total_sq):
+        # Mean squared error of the node around its mean, in the centered units of the split scores
+        return max(total_sq - total_sum * total_sum / n, 0) / n
+
+    def _best_split_sorted(self, X, y, orders, features):
         best_mse = float('inf')
         best_feature_index = None
         best_threshold = None
 
-        n_features = len(X[0])
-        for feature_index in range(n_features):
-            feature_values = [X[i][feature_index] for i in range(len(X))]
-            thresholds = self._possible_tresholds(feature_values)
+        n = orders.shape[1]
+        # Centering keeps the sums of squares small, so less precision is lost in the subtraction
+        offset = y[orders[0]].mean()
+        total_sum = float(np.sum(y[orders[0]] - offset))
+        total_sq = float(np.sum((y[orders[0]] - offset) ** 2))
+        tolerance = self._tie_tolerance(n, total_sum, total_sq)
+        left_n = np.arange(1, n)
+        min_leaf = self.min_samples_leaf
 
-            for threshold in thresholds:
-                left_X, right_X, left_y, right_y = self._split_dataset(X, y, feature_index, threshold)
-                if len(left_y) == 0 or len(right_y) == 0:
-                    continue
+        for feature_index in features:
+            order = orders[feature_index]
+            values = X[order, feature_index]
+            targets = y[order[:-1]] - offset
+            left_sum = np.cumsum(targets)
+            left_sq = np.cumsum(targets * targets)
 
-                mse = (len(left_y) * self._mse(left_y) + len(right_y) * self._mse(right_y)) / len(y)
+            mse = self._split_score(left_n, left_sum, left_sq, n, total_sum, total_sq)
+            mse[values[:-1] == values[1:]] = np.inf
+            if min_leaf > 1:
+                mse[:min_leaf - 1] = np.inf
+                mse[n - min_leaf:] = np.inf
 
-                if mse < best_mse:
-                    best_mse = mse
-                    best_feature_index = feature_index
-                    best_threshold = threshold
-        return best_feature_index, best_threshold
+            pos, feature_mse = self._first_best(mse, tolerance)
+            if pos is not None and feature_mse < best_mse - tolerance:
+                best_mse = feature_mse
+                best_feature_index = int(feature_index)
+                best_threshold = float((values[pos] + values[pos + 1]) / 2)
+        return best_feature_index, best_threshold, self._node_error(n, total_sum, total_sq) - best_mse
 
-    def _build_tree(self, X, y, depth):
-        if len(y) < self.min_samples_split or depth >= self.max_depth:
-            return TreeNode(value=sum(y) / len(y))
+    def _best_split_binned(self, y, rows, features):
+        best_mse = float('inf')
+        best_feature_index = None
+        best_threshold = None
 
-        feature_index, threshold = self._best_split(X, y)
-        if feature_index is None:
-            return TreeNode(value=sum(y) / len(y))
+        n = len(rows)
+        targets = y[rows] - y[rows].mean()
+        total_sum = float(np.sum(targets))
+        total_sq = float(np.sum(targets * targets))
+        tolerance = self._tie_tolerance(n, total_sum, total_sq)
+        codes = self._bins[rows]
+        min_leaf = self.min_samples_leaf
 
-        left_X, right_X, left_y, right_y = self._split_dataset(X, y, feature_index, threshold)
+        for feature_index in features:
+            edges = self._bin_edges[feature_index]
+            n_bins = len(edges) + 1
+            counts = np.bincount(codes[:, feature_index], minlength=n_bins)[:-1]
+            sums = np.bincount(codes[:, feature_index], weights=targets, minlength=n_bins)[:-1]
+            squares = np.bincount(codes[:, feature_index], weights=targets * targets, minlength=n_bins)[:-1]
 
-        left_child = self._build_tree(left_X, left_y, depth + 1)
-        right_child = self._build_tree(right_X, right_y, depth + 1)
-        return TreeNode(feature_index=feature_index, threshold=threshold, left=left_child, right=right_child)
+            left_n = np.cumsum(counts)
+            mse = self._split_score(np.clip(left_n, 1, n - 1), np.cumsum(sums), np.cumsum(squares), n, total_sum, total_sq)
+            mse[(counts == 0) | (left_n == n)] = np.inf
+            if min_leaf > 1:
+                mse[(left_n < min_leaf) | (n - left_n < min_leaf)] = np.inf
 
-    def _predict_sample(self, node, sample):
-        if node.value is not None:
-            return node.value
+            pos, feature_mse = self._first_best(mse, tolerance)
+            if pos is not None and feature_mse < best_mse - tolerance:
+                best_mse = feature_mse
+                best_feature_index = int(feature_index)
+                best_threshold = float(edges[pos])
+        return best_feature_index, best_threshold, self._node_error(n, total_sum, total_sq) - best_mse
 
-        if sample[node.feature_index] <= node.threshold:
-            return self._predict_sample(node.left, sample)
+    def _best_split(self, X, y, rows, orders):
+        # (feature, threshold, decrease of the node's mean squared error); feature is None if nothing splits
+        if len(rows) < 2:
+            return None, None, 0.0
+        features = self._split_features(X.shape[1])
+        with metrics.timer('cart.best_split'):
+            if orders is None:
+                split = self._best_split_binned(y, rows, features)
+            else:
+                split = self._best_split_sorted(X, y, orders, features)
+        if metrics.enabled:
+            metrics.count('cart.split_searches')
+            if orders is None:
+                metrics.count('cart.thresholds_evaluated', sum(len(self._bin_edges[f]) for f in features))
+            else:
+                metrics.count('cart.thresholds_evaluated', len(features) * (orders.shape[1] - 1))
+        return split
+
+    def _find_split(self, X, y, rows, orders, depth):
+        # The split a node gets, or None when it stays a leaf
+        if len(rows) < max(self.min_samples_split, 2 * self.min_samples_leaf) or depth >= self.max_depth:
+            return None
+        feature, threshold, decrease = self._best_split(X, y, rows, orders)
+        if feature is None:
+            return None
+        # Weighted like the node's share of the training rows, so one threshold serves every depth
+        decrease *= len(rows) / self._n_root
+        if self.min_impurity_decrease and decrease < self.min_impurity_decrease:
+            return None
+        return feature, threshold, decrease
+
+    def _build_tree(self, X, y, rows, orders):
+        feature_index, threshold, left, right, value = [-1], [0.0], [-1], [-1], [0.0]
+        self._n_root = len(rows)
+        partitioned = 0
+
+        def split_node(node_id, rows, orders, split):
+            # Turns a leaf into an internal node; returns the (node id, rows, orders) of both children
+            nonlocal partitioned
+            best_feature, best_threshold, _ = split
+            left_mask = X[rows, best_feature] <= best_threshold
+            partitioned += len(rows)
+            left_orders = right_orders = None
+            if orders is not None:
+                self._goes_left[rows] = left_mask
+                order_mask = self._goes_left[orders]
+                left_orders = orders[order_mask].reshape(len(orders), -1)
+                right_orders = orders[~order_mask].reshape(len(orders), -1)
+
+            left_id = len(value)
+            feature_index[node_id] = best_feature
+            threshold[node_id] = best_threshold
+            left[node_id] = left_id
+            right[node_id] = left_id + 1
+            for _ in range(2):
+                feature_index.append(-1)
+                threshold.append(0.0)
+                left.append(-1)
+                right.append(-1)
+                value.append(0.0)
+            return (left_id, rows[left_mask], left_orders), (left_id + 1, rows[~left_mask], right_orders)
+
+        if self.max_leaf_nodes is None:
+            # Depth-first with an explicit stack, so tree depth is not bounded by the recursion limit
+            stack = [(0, rows, orders, 0)]
+            while stack:
+                node_id, rows, orders, depth = stack.pop()
+                value[node_id] = float(y[rows].mean())
+                split = self._find_split(X, y, rows, orders, depth)
+                if split is None:
+                    continue
+                left_child, right_child = split_node(node_id, rows, orders, split)
+                stack.append(right_child + (depth + 1,))
+                stack.append(left_child + (depth + 1,))
         else:
-            return self._predict_sample(node.right, sample)
\ No newline at end of file
+            # Best-first: the leaf whose split lowers the error most is split next, until the leaf budget is spent
+            frontier = []
+
+            def add_leaf(node_id, rows, orders, depth):
+                value[node_id] = float(y[rows].mean())
+                split = self._find_split(X, y, rows, orders, depth)
+                if split is not None:
+                    heapq.heappush(frontier, (-split[2], node_id, rows, orders, depth, split))
+
+            add_leaf(0, rows, orders, 0)
+            n_leaves = 1
+            while frontier and n_leaves < self.max_leaf_nodes:
+                _, node_id, rows, orders, depth, split = heapq.heappop(frontier)
+                left_child, right_child = split_node(node_id, rows, orders, split)
+                n_leaves += 1
+                add_leaf(*left_child, depth + 1)
+                add_leaf(*right_child, depth + 1)
+
+        if metrics.enabled:
+            metrics.count('cart.trees_built')
+            metrics.count('cart.nodes_built', len(value))
+            metrics.count('cart.samples_partitioned', partitioned)
+        return TreeArrays(feature_index, threshold, left, right, value)
@@ -0,0 +1,256 @@
+import numpy as np
+
+from src.utils.instrumentation import metrics
+
+LEAF_SIZE = 64
+# Box distances are summed in a different order than point distances; never prune a box that
+# could only look farther than the current k-th neighbour because of that rounding
+PRUNE_SLACK = 1 + 1e-9
+# Rows added by extend() are searched by brute force, next to the tree, until there are more than this many
+# (or more than a quarter of the indexed rows); then the tree is rebuilt over all of them
+MAX_PENDING = 4096
+# Queries per block when the pending rows are scanned, bounding the queries x pending distance matrix
+QUERY_BLOCK = 4096
+# Up to this many rows a query scans every row: on small stores that beats the fixed cost of the tree descent
+BRUTE_FORCE_ROWS = 1024
+# Distance matrix entries per block of a brute-force scan
+BRUTE_FORCE_BLOCK = 1 << 20
+
+def squared_distances(queries, points):
+    # Accumulated feature by feature, the order of a row-wise sum, keeping the block at queries x points
+    metrics.count('knn.distances_computed', len(queries) * len(points))
+    squared = np.zeros((len(queries), len(points)))
+    for i in range(points.shape[1]):
+        squared += (queries[:, i, None] - points[None, :, i]) ** 2
+    return squared
+
+class KDTree:
+    FIELDS = ('indices', 'start', 'end', 'left', 'right', 'split_dim', 'split_value', 'lower', 'upper')
+
+    def __init__(self, data, leaf_size=LEAF_SIZE, scale=None):
+        # scale: multiplier decoding quantized (integer) data into feature units; None for float data
+        self.data = data
+        self.leaf_size = leaf_size
+        self.scale = scale
+        self._build()
+
+    def to_arrays(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def extend(self, data):
+        # data is the indexed rows followed by the new ones; row ids of the indexed rows must not change
+        self.data = data
+        n_indexed = len(self.indices)
+        if len(data) - n_indexed > max(self.leaf_size, min(MAX_PENDING, n_indexed // 4)):
+            self._build()
+
+    @classmethod
+    def from_arrays(cls, data, leaf_size, arrays, scale=None):
+        tree = cls.__new__(cls)
+        tree.data = data
+        tree.leaf_size = leaf_size
+        tree.scale = scale
+        for field in cls.FIELDS:
+            setattr(tree, field, arrays[field])
+        return tree
+
+    def _build(self):
+        with metrics.timer('knn.build_index'):
+            self._build_nodes()
+
+    def _rows(self, idx):
+        # Rows in feature units: distances, boxes and splits are all computed from the decoded values
+        rows = self.data[idx]
+        return rows if self.scale is None else rows * self.scale
+
+    def _build_nodes(self):
+        n_samples = len(self.data)
+        self.indices = np.arange(n_samples)
+        start, end, left, right, split_dim, split_value, lower, upper = [], [], [], [], [], [], [], []
+
+        stack = [(0, n_samples, -1, False)]
+        while stack:
+            lo, hi, parent, is_left = stack.pop()
+            node_id = len(start)
+            if parent >= 0:
+                (left if is_left else right)[parent] = node_id
+
+            points = self._rows(self.indices[lo:hi])
+            start.append(lo)
+            end.append(hi)
+            left.append(-1)
+            right.append(-1)
+            split_dim.append(0)
+            split_value.append(0.0)
+            lower.append(points.min(axis=0))
+            upper.append(points.max(axis=0))
+
+            spread = upper[-1] - lower[-1]
+            dim = int(np.argmax(spread))
+            if hi - lo <= self.leaf_size or spread[dim] == 0:
+                continue
+
+            # Split the widest dimension at its median value, never between equal values, so that
+            # sibling boxes do not overlap even on binary and categorical columns
+            segment = self.indices[lo:hi]
+            values = points[:, dim]
+            median = np.partition(values, len(values) // 2)[len(values) // 2]
+            goes_left = values < median
+            if not goes_left.any():
+                goes_left = values <= median
+            mid = lo + int(np.count_nonzero(goes_left))
+            self.indices[lo:hi] = np.concatenate((segment[goes_left], segment[~goes_left]))
+            split_dim[-1] = dim
+            split_value[-1] = (values[goes_left].max() + values[~goes_left].min()) / 2
+            stack.append((mid, hi, node_id, False))
+            stack.append((lo, mid, node_id, True))
+
+        self.start = np.array(start, dtype=np.intp)
+        self.end = np.array(end, dtype=np.intp)
+        self.left = np.array(left, dtype=np.intp)
+        self.right = np.array(right, dtype=np.intp)
+        self.split_dim = np.array(split_dim, dtype=np.intp)
+        self.split_value = np.array(split_value, dtype=np.float64)
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+
+    def _home_nodes(self, X, k):
+        # Deepest node on each query's path that still holds k rows; scanning it gives a finite first bound
+        nodes = np.zeros(len(X), dtype=np.intp)
+        sizes = self.end - self.start
+        active = np.flatnonzero(self.left[nodes] >= 0)
+        while len(active):
+            current = nodes[active]
+            goes_left = X[active, self.split_dim[current]] <= self.split_value[current]
+            child = np.where(goes_left, self.left[current], self.right[current])
+            deeper = sizes[child] >= k
+            active, child = active[deeper], child[deeper]
+            nodes[active] = child
+            active = active[self.left[child] >= 0]
+        return nodes
+
+    def _box_distances(self, points, nodes):
+        gap = np.maximum(self.lower[nodes] - points, 0) + np.maximum(points - self.upper[nodes], 0)
+        return np.einsum('ij,ij->i', gap, gap)
+
+    def _node_rows(self, nodes):
+        # Training rows of several nodes as one array, without a Python loop over the nodes
+        lengths = self.end[nodes] - self.start[nodes]
+        offsets = np.repeat(self.start[nodes] - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + np.arange(lengths.sum())]
+
+    def _merge(self, group, idx, best_d2, best_idx, X):
+        d2 = squared_distances(X[group], self._rows(idx))
+        # Only points within the current k-th distance of some query in the group can enter
+        candidates = (d2 <= best_d2[group, -1:]).any(axis=0)
+        if not candidates.any():
+            return
+        d2, idx = d2[:, candidates], idx[candidates]
+
+        all_d2 = np.concatenate((best_d2[group], d2), axis=1)
+        all_idx = np.concatenate((best_idx[group], np.broadcast_to(idx, d2.shape)), axis=1)
+        # Equal distances are ordered by training row, like a stable sort over all rows
+        with metrics.timer('knn.sort_candidates'):
+            keep = np.lexsort((all_idx, all_d2), axis=-1)[:, :best_d2.shape[1]]
+        best_d2[group] = np.take_along_axis(all_d2, keep, axis=1)
+        best_idx[group] = np.take_along_axis(all_idx, keep, axis=1)
+
+    def _scan_nodes(self, X, queries, nodes, best_d2, best_idx):
+        if len(queries) == 0:
+            return
+
+        # Loop over whichever side is smaller: queries sharing a node are scored together,
+        # queries spread over many nodes gather each query's nodes into one block
+        by_query = len(np.unique(queries)) < len(np.unique(nodes))
+        keys = queries if by_query else nodes
+        order = np.argsort(keys, kind='stable')
+        queries, nodes, keys = queries[order], nodes[order], keys[order]
+        boundaries = np.flatnonzero(np.diff(keys)) + 1
+
+        for group, group_nodes in zip(np.split(queries, boundaries), np.split(nodes, boundaries)):
+            if by_query:
+                self._merge(group[:1], self._node_rows(group_nodes), best_d2, best_idx, X)
+            else:
+                self._merge(group, self._node_rows(group_nodes[:1]), best_d2, best_idx, X)
+
+    def query(self, X, k):
+        k = min(k, len(self.data))
+        if len(self.data) <= BRUTE_FORCE_ROWS:
+            with metrics.timer('knn.brute_force_search'):
+                return self._query_brute_force(X, k)
+        n_indexed = len(self.indices)
+        with metrics.timer('knn.tree_search'):
+            best_d2, best_idx = self._query_indexed(X, min(k, n_indexed))
+        if n_indexed < len(self.data):
+            with metrics.timer('knn.pending_search'):
+                best_d2, best_idx = self._merge_pending(X, k, best_d2, best_idx)
+        return np.sqrt(best_d2), best_idx
+
+    def _query_brute_force(self, X, k):
+        # Same neighbours, distances and tie order as the tree: argpartition finds the k nearest rows, and only
+        # queries with ties at the k-th distance fall back to a full stable sort of their row
+        points = self._rows(np.arange(len(self.data)))
+        best_d2 = np.empty((len(X), k))
+        best_idx = np.empty((len(X), k), dtype=np.intp)
+        if k == 0:
+            return best_d2, best_idx
+        block = max(1, BRUTE_FORCE_BLOCK // len(points))
+        for lo in range(0, len(X), block):
+            hi = min(lo + block, len(X))
+            d2 = squared_distances(X[lo:hi], points)
+            idx = np.sort(np.argpartition(d2, k - 1, axis=1)[:, :k], axis=1)
+            idx_d2 = np.take_along_axis(d2, idx, axis=1)
+            tied = np.flatnonzero(np.count_nonzero(d2 <= idx_d2.max(axis=1, keepdims=True), axis=1) > k)
+            if len(tied):
+                idx[tied] = np.argsort(d2[tied], axis=1, kind='stable')[:, :k]
+                idx_d2[tied] = np.take_along_axis(d2[tied], idx[tied], axis=1)
+            order = np.argsort(idx_d2, axis=1, kind='stable')
+            best_d2[lo:hi] = np.take_along_axis(idx_d2, order, axis=1)
+            best_idx[lo:hi] = np.take_along_axis(idx, order, axis=1)
+        return np.sqrt(best_d2), best_idx
+
+    def _merge_pending(self, X, k, best_d2, best_idx):
+        # Same (distance, row id) order as a tree rebuilt over every row
+        pending = np.arange(len(self.indices), len(self.data))
+        merged_d2 = np.empty((len(X), k))
+        merged_idx = np.empty((len(X), k), dtype=np.intp)
+        for lo in range(0, len(X), QUERY_BLOCK):
+            hi = min(lo + QUERY_BLOCK, len(X))
+            d2 = np.concatenate((best_d2[lo:hi], squared_distances(X[lo:hi], self._rows(pending))), axis=1)
+            idx = np.concatenate((best_idx[lo:hi], np.broadcast_to(pending, (hi - lo, len(pending)))), axis=1)
+            order = np.lexsort((idx, d2))[:, :k]
+            merged_d2[lo:hi] = np.take_along_axis(d2, order, axis=1)
+            merged_idx[lo:hi] = np.take_along_axis(idx, order, axis=1)
+        return merged_d2, merged_idx
+
+    def _query_indexed(self, X, k):
+        n_queries = len(X)
+        best_d2 = np.full((n_queries, k), np.inf)
+        best_idx = np.full((n_queries, k), len(self.data), dtype=np.intp)
+        if n_queries == 0:
+            return best_d2, best_idx
+
+        # The rows around each query give a first bound on its k-th neighbour distance
+        home = self._home_nodes(X, k)
+        self._scan_nodes(X, np.arange(n_queries), home, best_d2, best_idx)
+        bound = best_d2[:, -1] * PRUNE_SLACK
+
+        # Then every (query, node) pair descends one level per pass, dropping boxes beyond the bound
+        queries = np.arange(n_queries)
+        nodes = np.zeros(n_queries, dtype=np.intp)
+        leaf_queries, leaf_nodes = [], []
+        while len(queries):
+            is_leaf = self.left[nodes] < 0
+            scanned = (self.start[nodes] >= self.start[home[queries]]) & (self.end[nodes] <= self.end[home[queries]])
+            found = is_leaf & ~scanned
+            leaf_queries.append(queries[found])
+            leaf_nodes.append(nodes[found])
+
+            parents = nodes[~is_leaf]
+            queries = np.tile(queries[~is_leaf], 2)
+            nodes = np.concatenate((self.left[parents], self.right[parents]))
+            near = self._box_distances(X[queries], nodes) <= bound[queries]
+            queries, nodes = queries[near], nodes[near]
+
+        self._scan_nodes(X, np.concatenate(leaf_queries), np.concatenate(leaf_nodes), best_d2, best_idx)
+        return best_d2, best_idx
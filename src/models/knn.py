@@ -1,58 +1,169 @@
-import math
+import numpy as np
+
+from src.models.kd_tree import KDTree
+from src.utils.instrumentation import metrics
+from src.utils.utils import as_float_array, row_quantiles
+
+# Storage of the normalized training rows. Normalized values lie in [0, 1], so the integer stores keep them as
+# multiples of 1 / levels: binary flags stay exact, other features are off by at most half a level.
+PRECISIONS = {'float64': None, 'float32': None, 'uint16': 65535, 'uint8': 255}
+# With rerank, the compact store proposes this many times k candidates, re-ordered by exact float64 distances
+RERANK_FACTOR = 4
 
 class KNN:
-    def __init__(self, k=5):
+    def __init__(self, k=5, precision='float64', rerank=False):
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {sorted(PRECISIONS)}, got {precision!r}")
         self.k = k
+        self.precision = precision
+        # Keeps a float64 copy of the normalized rows (memory-mapped once saved) to re-rank the candidates
+        self.rerank = rerank
         self.X_train = None
+        self.X_exact = None
         self.y_train = None
         self.min_vals = None
         self.max_vals = None
+        self.index = None
+
+    def __setstate__(self, state):
+        # Models pickled before the NumPy port hold plain lists and have no index
+        self.__init__()
+        self.__dict__.update(state)
+        self.X_train = as_float_array(self.X_train)
+        self.y_train = np.asarray(self.y_train, dtype=np.float64)
+        self.min_vals = as_float_array(self.min_vals)
+        self.max_vals = as_float_array(self.max_vals)
+        if getattr(self, 'index', None) is None:
+            self.index = KDTree(self.X_train)
+
+    def get_params(self):
+        return {'k': self.k, 'precision': self.precision, 'rerank': self.rerank}
+
+    def to_arrays(self):
+        arrays = {'X_train': self.X_train, 'y_train': self.y_train,
+                  'min_vals': self.min_vals, 'max_vals': self.max_vals}
+        if self.X_exact is not None:
+            arrays['X_exact'] = self.X_exact
+        for field, array in self.index.to_arrays().items():
+            arrays[f'index_{field}'] = array
+        return dict(self.get_params(), leaf_size=self.index.leaf_size), arrays
+
+    @classmethod
+    def from_arrays(cls, params, arrays):
+        params = dict(params)
+        leaf_size = params.pop('leaf_size')
+        knn = cls(**params)
+        knn.X_train = arrays['X_train']
+        knn.X_exact = arrays.get('X_exact')
+        knn.y_train = arrays['y_train']
+        knn.min_vals = arrays['min_vals']
+        knn.max_vals = arrays['max_vals']
+        index_arrays = {field: arrays[f'index_{field}'] for field in KDTree.FIELDS}
+        knn.index = KDTree.from_arrays(knn.X_train, leaf_size, index_arrays, knn._scale())
+        return knn
+
+    def _scale(self):
+        levels = PRECISIONS[self.precision]
+        return None if levels is None else 1.0 / levels
+
+    def _encode(self, X_norm):
+        levels = PRECISIONS[self.precision]
+        if levels is None:
+            return X_norm.astype(self.precision, copy=False)
+        return np.rint(np.clip(X_norm, 0, 1) * levels).astype(self.precision)
+
+    def _decode(self, X_store):
+        scale = self._scale()
+        return X_store.astype(np.float64) if scale is None else X_store * scale
 
     def _normalize(self, X):
-        X_norm = []
-        for row in X:
-            norm_row = []
-            for i in range(len(row)):
-                denom = (self.max_vals[i] - self.min_vals[i])
-                if denom == 0:
-                    norm_row.append(0)
-                else:
-                    norm_row.append((row[i] - self.min_vals[i]) / denom)
-            X_norm.append(norm_row)
+        denom = self.max_vals - self.min_vals
+        X_norm = np.zeros(X.shape, dtype=np.result_type(X, denom))
+        np.divide(X - self.min_vals, denom, out=X_norm, where=denom != 0)
         return X_norm
 
+    def _keeps_exact(self):
+        return self.rerank and self.precision != 'float64'
+
     def fit(self, X, y):
-        self.min_vals = [min(row[i] for row in X) for i in range(len(X[0]))]
-        self.max_vals = [max(row[i] for row in X) for i in range(len(X[0]))]
+        X = as_float_array(X)
+        self.min_vals = X.min(axis=0)
+        self.max_vals = X.max(axis=0)
 
-        self.X_train = self._normalize(X)
-        self.y_train = y
+        X_norm = self._normalize(X)
+        self.X_train = self._encode(X_norm)
+        self.X_exact = X_norm if self._keeps_exact() else None
+        self.y_train = np.asarray(y, dtype=np.float64)
+        self.index = KDTree(self.X_train, scale=self._scale())
 
-    def _euclidean_distance(self, row1, row2):
-        return math.sqrt(sum((row1[i] - row2[i]) ** 2 for i in range(len(row1))))
+    def partial_fit(self, X, y):
+        # Appends new rows to the training store and index. The stored rows only change when the new ones reach
+        # outside min_vals / max_vals: then the range grows and everything is normalized again to the new range.
+        X = as_float_array(X)
+        y = np.asarray(y, dtype=np.float64)
+        if len(X) == 0:
+            return
 
-    def predict(self, X_test):
-        X_test_norm = self._normalize(X_test)
-        predictions = []
+        min_vals = np.minimum(self.min_vals, X.min(axis=0))
+        max_vals = np.maximum(self.max_vals, X.max(axis=0))
+        X_train, X_exact = self.X_train, self.X_exact
+        range_grew = not (np.array_equal(min_vals, self.min_vals) and np.array_equal(max_vals, self.max_vals))
+        if range_grew:
+            # Back to feature units with the old range, then normalized to the new one. The exact copy, when
+            # there is one, is the source for both stores, so quantization errors do not add up over updates.
+            denom = self.max_vals - self.min_vals
+            X_stored = self._decode(X_train) if X_exact is None else X_exact
+            X_raw = np.where(denom != 0, X_stored * denom + self.min_vals, self.min_vals)
+            self.min_vals, self.max_vals = min_vals, max_vals
+            X_renormalized = self._normalize(X_raw)
+            X_train = self._encode(X_renormalized)
+            X_exact = X_renormalized if X_exact is not None else None
 
-        for test_row in X_test_norm:
-            distances = []
-            for i in range(len(self.X_train)):
-                dist = self._euclidean_distance(test_row, self.X_train[i])
-                distances.append((self.y_train[i], dist))
+        X_norm = self._normalize(X)
+        self.X_train = np.concatenate((X_train, self._encode(X_norm)))
+        if X_exact is not None:
+            self.X_exact = np.concatenate((X_exact, X_norm))
+        self.y_train = np.concatenate((self.y_train, y))
+        if range_grew:
+            self.index = KDTree(self.X_train, self.index.leaf_size, self._scale())
+        else:
+            self.index.extend(self.X_train)
 
-            distances.sort(key=lambda x: x[1])
-            neighbors = distances[:self.k]
+    def _weighted_average(self, prices, dists):
+        weights = 1 / (dists + 1e-5)
+        weighted_sum = np.zeros(len(prices))
+        total_weight = np.zeros(len(prices))
+        for j in range(prices.shape[1]):
+            weighted_sum += prices[:, j] * weights[:, j]
+            total_weight += weights[:, j]
+        return weighted_sum / total_weight
 
-            total_weight = 0
-            weighted_sum = 0
+    def _rerank(self, X_test_norm, candidates):
+        # Exact distances to the candidates of the compact search; equal distances keep the lower row first
+        k = min(self.k, candidates.shape[1])
+        d2 = np.zeros(candidates.shape)
+        for i in range(X_test_norm.shape[1]):
+            d2 += (self.X_exact[candidates, i] - X_test_norm[:, i, None]) ** 2
+        order = np.lexsort((candidates, d2), axis=-1)[:, :k]
+        return np.sqrt(np.take_along_axis(d2, order, axis=1)), np.take_along_axis(candidates, order, axis=1)
 
-            for price, dist in neighbors:
-                weight = 1 / (dist + 1e-5)
-                weighted_sum += price * weight
-                total_weight += weight
+    def _neighbors(self, X_test):
+        X_test_norm = self._normalize(as_float_array(X_test))
+        metrics.count('knn.queries', len(X_test_norm))
+        if self.X_exact is None:
+            return self.index.query(X_test_norm, self.k)
+        _, candidates = self.index.query(X_test_norm, self.k * RERANK_FACTOR)
+        return self._rerank(X_test_norm, candidates)
 
-            avg_price = weighted_sum / total_weight
-            predictions.append(avg_price)
+    def predict(self, X_test):
+        with metrics.timer('knn.predict'):
+            distances, neighbors = self._neighbors(X_test)
+            return self._weighted_average(self.y_train[neighbors], distances)
 
-        return predictions
\ No newline at end of file
+    def predict_distribution(self, X_test, quantiles):
+        # predict() plus the spread of the neighbour prices of every row, from the same search: returns the
+        # weighted mean, the (samples x len(quantiles)) quantiles and the standard deviation
+        with metrics.timer('knn.predict'):
+            distances, neighbors = self._neighbors(X_test)
+            prices = self.y_train[neighbors]
+            return self._weighted_average(prices, distances), row_quantiles(prices, quantiles), prices.std(axis=1)
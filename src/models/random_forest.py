@@ -1,40 +1,219 @@
-import random
+import numpy as np
 
-from src.models.cart import CARTRegressor
+from src.models.cart import CARTRegressor, TreeArrays, presort
+from src.utils.config import MAX_BINS, RANDOM_SEED, ROLLING_REPLACE
+from src.utils.instrumentation import metrics
+from src.utils.shared_arrays import share_arrays, attach_arrays, release_arrays
+from src.utils.workers import resolve_n_jobs, worker_pool, worker_state
+from src.utils.utils import as_float_array, calculate_metrics, row_quantiles
+
+def _setup_worker(handles, forest, instrumented=False):
+    # A worker keeps the training data, attached once from shared memory, and the tree-less forest whose
+    # hyperparameters its trees are built with
+    if instrumented:
+        metrics.enable()
+    return attach_arrays(handles), forest
+
+def _fit_tree_in_worker(seed):
+    (X, y, rows, *orders), forest = worker_state()
+    tree = forest._fit_tree(X, y, seed, rows, orders[0] if orders else None)
+    # The worker's timers and counters travel back with the tree and are merged in the parent
+    return tree, metrics.drain() if metrics.enabled else None
 
 class RandomForestRegressor:
-    def __init__(self, n_trees=10, max_depth=7, min_samples_split=5):
+    def __init__(self, n_trees=10, max_depth=7, min_samples_split=5, max_bins=MAX_BINS,
+                 n_jobs=1, random_state=RANDOM_SEED, oob_score=True, max_features=None, min_samples_leaf=1,
+                 min_impurity_decrease=0.0, max_leaf_nodes=None):
         self.n_trees = n_trees
         self.max_depth = max_depth
         self.min_samples_split = min_samples_split
+        self.max_bins = max_bins
+        # Passed to every CARTRegressor; the feature draws of a tree continue its bootstrap's random stream
+        self.max_features = max_features
+        self.min_samples_leaf = min_samples_leaf
+        self.min_impurity_decrease = min_impurity_decrease
+        self.max_leaf_nodes = max_leaf_nodes
+        # Number of worker processes; -1 uses every core, 1 trains in the calling process
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        # Out-of-bag MAE / MAPE computed by fit: every row is predicted by the trees whose bootstrap left it out
+        self.oob_score = oob_score
+        self.oob_metrics = None
         self.trees = []
+        # Trees trained over the forest's lifetime (fit plus every partial_fit); numbers the seeds of new trees
+        self.trees_trained = 0
+        self._forest = None
+
+    def __setstate__(self, state):
+        # Attributes added since a model was pickled keep their defaults
+        self.__init__()
+        self.__dict__.update(state)
+        self._forest = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_forest'] = None
+        return state
+
+    def get_params(self):
+        return {'n_trees': self.n_trees, 'max_depth': self.max_depth, 'min_samples_split': self.min_samples_split,
+                'max_bins': self.max_bins, 'n_jobs': self.n_jobs, 'random_state': self.random_state,
+                'oob_score': self.oob_score, **self._tree_params()}
+
+    def _tree_params(self):
+        return {'max_features': self.max_features, 'min_samples_leaf': self.min_samples_leaf,
+                'min_impurity_decrease': self.min_impurity_decrease, 'max_leaf_nodes': self.max_leaf_nodes}
+
+    def to_arrays(self):
+        forest, roots = self._compiled_forest()
+        arrays = forest.to_arrays()
+        arrays['roots'] = roots
+        return dict(self.get_params(), trees_trained=self.trees_trained, oob_metrics=self.oob_metrics), arrays
+
+    @classmethod
+    def from_arrays(cls, params, arrays):
+        params = dict(params)
+        trees_trained = params.pop('trees_trained', None)
+        oob_metrics = params.pop('oob_metrics', None)
+        forest = cls(**params)
+        forest.oob_metrics = oob_metrics
+        # The concatenated node table is used as is (it may be memory-mapped); per-tree tables are small copies
+        nodes = TreeArrays(*(arrays[field] for field in TreeArrays.FIELDS))
+        roots = np.asarray(arrays['roots'], dtype=np.intp)
+        ends = np.append(roots[1:], len(nodes))
+        for start, end in zip(roots, ends):
+            tree = CARTRegressor(max_depth=forest.max_depth, min_samples_split=forest.min_samples_split,
+                                 max_bins=forest.max_bins, **forest._tree_params())
+            tree.tree = TreeArrays(
+                nodes.feature_index[start:end], nodes.threshold[start:end],
+                np.where(nodes.left[start:end] >= 0, nodes.left[start:end] - start, -1),
+                np.where(nodes.right[start:end] >= 0, nodes.right[start:end] - start, -1),
+                nodes.value[start:end])
+            forest.trees.append(tree)
+        forest._forest = (nodes, roots)
+        forest.trees_trained = len(forest.trees) if trees_trained is None else trees_trained
+        return forest
+
+    def _get_bootstrap_sample(self, n_samples, rng):
+        return rng.integers(0, n_samples, size=n_samples)
+
+    def _tree_seeds(self, first, count):
+        # Tree number i gets child i of the forest's seed, so the forest does not depend on which process builds
+        # which tree, and trees added later by partial_fit get fresh seeds (the same children SeedSequence.spawn gives)
+        return [np.random.SeedSequence(self.random_state, spawn_key=(i,)) for i in range(first, first + count)]
 
-    def _get_bootstrap_sample(self, X, y):
-        n_samples = len(X)
-        indices = [random.randint(0, n_samples - 1) for _ in range(n_samples)]
-        X_sample = [X[i] for i in indices]
-        y_sample = [y[i] for i in indices]
-        return X_sample, y_sample
+    def _fit_tree(self, X, y, seed, rows, orders=None):
+        rng = np.random.default_rng(seed)
+        indices = rows[self._get_bootstrap_sample(len(rows), rng)]
+
+        tree = CARTRegressor(max_depth=self.max_depth, min_samples_split=self.min_samples_split,
+                             max_bins=self.max_bins, random_state=rng, **self._tree_params())
+
+        tree._fit_rows(X, y, indices, orders)
+        # The generator only served this fit; trees travel back from worker processes without it
+        tree.random_state = None
+        return tree
 
     def fit(self, X, y):
+        X = as_float_array(X)
+        y = np.asarray(y, dtype=np.float64)
+        self._fit_rows(X, y, np.arange(len(X)))
+
+    def _fit_rows(self, X, y, rows, orders=None):
+        # Trains on X[rows] without copying it (e.g. one cross-validation fold). The features are sorted once
+        # for the whole forest, unless the caller already holds presort(X).
         self.trees = []
-        for i in range(self.n_trees):
-            X_sample, y_sample = self._get_bootstrap_sample(X, y)
+        self._forest = None
+        seeds = self._tree_seeds(0, self.n_trees)
+        self.trees = self._train_trees(X, y, rows, seeds, orders)
+        self.trees_trained = self.n_trees
+        self.oob_metrics = self._oob_metrics(X, y, rows, seeds) if self.oob_score else None
 
-            tree = CARTRegressor(max_depth=self.max_depth, min_samples_split=self.min_samples_split)
+    def _oob_metrics(self, X, y, rows, seeds):
+        # The bootstrap of each tree is drawn again from its seed, so workers never send their samples back.
+        # Each tree predicts the rows it left out in one batch; the sums are averaged over the trees per row.
+        with metrics.timer('forest.oob'):
+            n = len(rows)
+            sums = np.zeros(n)
+            counts = np.zeros(n, dtype=np.int64)
+            in_bag = np.empty(n, dtype=bool)
+            for tree, seed in zip(self.trees, seeds):
+                in_bag[:] = False
+                in_bag[self._get_bootstrap_sample(n, np.random.default_rng(seed))] = True
+                out_of_bag = np.flatnonzero(~in_bag)
+                sums[out_of_bag] += tree.tree.predict(X[rows[out_of_bag]])
+                counts[out_of_bag] += 1
 
-            tree.fit(X_sample, y_sample)
-            self.trees.append(tree)
+            covered = counts > 0
+            if not covered.any():
+                return None
+            mae, mape = calculate_metrics(y[rows[covered]], sums[covered] / counts[covered])
+            return {'mae': mae, 'mape': mape, 'n_samples': int(covered.sum())}
 
-    def predict(self, X):
-        tree_predictions = [tree.predict(X) for tree in self.trees]
+    def partial_fit(self, X, y, n_replace=None):
+        # Rolling forest: the n_replace oldest trees are retired and replaced by trees trained on X, y, so the forest
+        # keeps its size and follows recent prices without retraining the rest. X should be a recent window of the
+        # data, not just the latest listings: update_models passes them together with the tail of the training rows.
+        X = as_float_array(X)
+        y = np.asarray(y, dtype=np.float64)
+        if n_replace is None:
+            n_replace = max(1, int(round(ROLLING_REPLACE * self.n_trees)))
+        n_replace = min(n_replace, self.n_trees)
+        if len(X) == 0 or n_replace == 0:
+            return
+
+        new_trees = self._train_trees(X, y, np.arange(len(X)), self._tree_seeds(self.trees_trained, n_replace))
+        self.trees = self.trees[n_replace:] + new_trees
+        self.trees_trained += n_replace
+        self._forest = None
+        # The estimate described the replaced trees
+        self.oob_metrics = None
 
-        final_predictions = []
-        n_samples = len(X)
+    def _train_trees(self, X, y, rows, seeds, orders=None):
+        if orders is None and not self.max_bins:
+            with metrics.timer('forest.presort'):
+                orders = presort(X)
 
-        for i in range(n_samples):
-            sample_preds = [tp[i] for tp in tree_predictions]
-            avg_pred = sum(sample_preds) / self.n_trees
-            final_predictions.append(avg_pred)
+        n_workers = resolve_n_jobs(self.n_jobs, len(seeds))
+        if n_workers == 1:
+            return [self._fit_tree(X, y, seed, rows, orders) for seed in seeds]
+
+        blocks, handles = share_arrays(X, y, rows, *(() if orders is None else (orders,)))
+        # Workers only need the hyperparameters: a copy without trees is sent once per worker, not once per tree
+        template = type(self)(**self.get_params())
+        try:
+            with worker_pool(n_workers, _setup_worker, handles, template, metrics.enabled) as pool:
+                trees = []
+                for tree, state in pool.map(_fit_tree_in_worker, seeds):
+                    trees.append(tree)
+                    if state is not None:
+                        metrics.merge(state)
+                return trees
+        finally:
+            release_arrays(blocks)
+
+    def _compiled_forest(self):
+        if self._forest is None:
+            self._forest = TreeArrays.concatenate([tree.tree for tree in self.trees])
+        return self._forest
+
+    def _tree_predictions(self, X):
+        X = as_float_array(X)
+        metrics.count('forest.rows_predicted', len(X))
+        forest, roots = self._compiled_forest()
+        # Every tree descends the whole batch at once: one (trees x samples) matrix of node ids
+        leaves = forest.apply(X, np.repeat(roots[:, None], len(X), axis=1))
+        return forest.value[leaves]
+
+    def predict(self, X):
+        with metrics.timer('forest.predict'):
+            tree_predictions = self._tree_predictions(X)
+            return tree_predictions.sum(axis=0) / self.n_trees
 
-        return final_predictions
\ No newline at end of file
+    def predict_distribution(self, X, quantiles):
+        # predict() plus the spread of the per-tree predictions of every row, from the same (trees x samples)
+        # matrix: returns the mean, the (samples x len(quantiles)) quantiles and the standard deviation
+        with metrics.timer('forest.predict'):
+            tree_predictions = self._tree_predictions(X)
+            mean = tree_predictions.sum(axis=0) / self.n_trees
+            return mean, row_quantiles(tree_predictions.T, quantiles), tree_predictions.std(axis=0)
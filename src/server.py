@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+import numpy as np
+
+from src.app_logic import MODEL_DIR, build_features, predict_ensemble
+from src.models.artifacts import load_artifact
+from src.utils.prediction_cache import PredictionCache
+from src.utils.instrumentation import metrics
+
+HOST = '127.0.0.1'
+PORT = 8080
+# A batch is predicted when it reaches MAX_BATCH_ROWS or BATCH_DEADLINE seconds after its first request arrived
+MAX_BATCH_ROWS = 512
+BATCH_DEADLINE = 0.005
+MAX_BODY_BYTES = 1 << 20
+CACHE_SIZE = 100000
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    # Collects the feature rows of concurrent requests and predicts them together, so both models run vectorized
+    # over the whole batch. Prediction runs in a worker thread; the event loop keeps accepting requests meanwhile.
+    def __init__(self, models, max_rows=MAX_BATCH_ROWS, deadline=BATCH_DEADLINE):
+        self.models = models
+        self.max_rows = max_rows
+        self.deadline = deadline
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.rows = 0
+
+    async def predict(self, features):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, future))
+        return await future
+
+    def _predict(self, features):
+        return predict_ensemble(self.models['rf'], self.models['knn'], features)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            n_rows = len(batch[0][0])
+            closes_at = loop.time() + self.deadline
+            while n_rows < self.max_rows:
+                timeout = closes_at - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_rows += len(item[0])
+
+            features = np.concatenate([item[0] for item in batch])
+            try:
+                p_rf, p_knn, p_final = await loop.run_in_executor(None, self._predict, features)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.rows += n_rows
+            start = 0
+            for rows, future in batch:
+                end = start + len(rows)
+                if not future.done():
+                    future.set_result((p_rf[start:end], p_knn[start:end], p_final[start:end]))
+                start = end
+
+
+class PredictionServer:
+    def __init__(self, model_dir=MODEL_DIR, max_rows=MAX_BATCH_ROWS, deadline=BATCH_DEADLINE,
+                 cache_size=CACHE_SIZE, cache_ttl=None):
+        # The artifact is loaded (memory-mapped) once for the lifetime of the server
+        self.header, models = load_artifact(model_dir)
+        self.batcher = MicroBatcher(models, max_rows, deadline)
+        # Repeated listings are answered from the cache; only new feature rows reach the batcher
+        self.cache = PredictionCache(cache_size, cache_ttl) if cache_size else None
+        self.started = time.time()
+
+    async def _predict(self, features):
+        if self.cache is None:
+            return await self.batcher.predict(features)
+
+        version = self.header['artifact_id']
+        features, cached, missing = self.cache.start_predict(features, version)
+        predicted = await self.batcher.predict(features[missing]) if missing else None
+        return self.cache.finish_predict(features, version, cached, missing, predicted)
+
+    async def handle_predict(self, body):
+        # Body: one listing object or a list of them, with the keys of build_features
+        payload = json.loads(body)
+        listings = payload if isinstance(payload, list) else [payload]
+        if not listings:
+            return 400, {'error': 'no listings'}
+        columns = {key: [listing.get(key) for listing in listings] for key in set().union(*listings)}
+        if not columns:
+            return 400, {'error': 'listings have no fields'}
+        features, valid = build_features(columns, self.header, len(listings))
+        if not valid.all():
+            return 400, {'error': 'missing values or unknown district / construction type',
+                         'invalid': np.flatnonzero(~valid).tolist()}
+
+        p_rf, p_knn, p_final = await self._predict(features)
+        results = [{'price': round(float(final), 2), 'rf_price': round(float(rf), 2), 'knn_price': round(float(knn), 2)}
+                   for rf, knn, final in zip(p_rf, p_knn, p_final)]
+        return 200, results if isinstance(payload, list) else results[0]
+
+    def handle_health(self):
+        return 200, {'status': 'ok', 'artifact_id': self.header['artifact_id'],
+                     'uptime': round(time.time() - self.started, 1),
+                     'batches': self.batcher.batches, 'rows': self.batcher.rows,
+                     'cache': self.cache.stats() if self.cache else None}
+
+    async def route(self, method, path, body):
+        try:
+            return await self._route(method, path, body)
+        except Exception as e:
+            # Whatever slipped through still gets an answer; the connection stays usable
+            print(f"Error handling {method} {path}: {e!r}")
+            return 500, {'error': 'internal error'}
+
+    async def _route(self, method, path, body):
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                return await self.handle_predict(body)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                return 400, {'error': f'invalid request: {e}'}
+        if path == '/health':
+            return self.handle_health()
+        if path == '/metrics' and metrics.enabled:
+            return 200, metrics.to_prometheus()
+        return 404, {'error': 'not found'}
+
+    async def handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive: one request after another on the same connection
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                if len(parts) != 3:
+                    break
+                method, path, version = parts
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # The body cannot be skipped without a valid length, so the connection is closed after it
+                    status, payload = 400, {'error': 'invalid Content-Length'}
+                    keep_alive = False
+                elif length > MAX_BODY_BYTES:
+                    status, payload = 413, {'error': 'body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.route(method, path.split('?', 1)[0], body)
+                    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                # Text payloads (the Prometheus /metrics page) are sent as they are, everything else as JSON
+                if isinstance(payload, str):
+                    data, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    data, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json'
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: {content_type}; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        print(f"Serving price estimates on http://{host}:{port} (artifact {self.header['artifact_id']})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP service for price estimates: POST /predict, GET /health, "
+                                                 "GET /metrics (with --instrument)")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_ROWS)
+    parser.add_argument('--deadline-ms', type=float, default=BATCH_DEADLINE * 1000)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help="0 disables the prediction cache")
+    parser.add_argument('--cache-ttl', type=float, default=None, help="seconds a cached price is reused")
+    parser.add_argument('--instrument', action='store_true', help="serve stage timers and counters on GET /metrics")
+    args = parser.parse_args()
+    if args.instrument:
+        metrics.enable()
+
+    server = PredictionServer(max_rows=args.max_batch, deadline=args.deadline_ms / 1000,
+                              cache_size=args.cache_size, cache_ttl=args.cache_ttl)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
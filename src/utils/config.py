@@ -1,4 +1,14 @@
 MAX_DEPTH = 6
 MIN_SAMPLES_SPLIT = 5
+MAX_BINS = None
+N_JOBS = -1
 TEST_SIZE = 0.2
-RANDOM_SEED = 42
\ No newline at end of file
+RANDOM_SEED = 42
+ROLLING_REPLACE = 0.2
+# Share of the most recent training rows the replacement trees of an update are trained on, next to the new rows
+ROLLING_WINDOW = 0.25
+# Storage of the KNN training rows: float64, float32, uint16 or uint8 (quantized; pair uint8 with rerank)
+KNN_PRECISION = 'float64'
+KNN_RERANK = False
+# Percentiles of the price range shown next to an estimate (spread over the trees and the KNN neighbours)
+PRICE_RANGE_QUANTILES = (0.1, 0.9)
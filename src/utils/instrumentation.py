@@ -0,0 +1,137 @@
+import os
+import re
+import json
+import time
+import threading
+
+# Set to 1 to enable the instrumentation from the start of the process (also in spawned worker processes)
+ENV_VARIABLE = 'ESTATE_INSTRUMENT'
+PROMETHEUS_PREFIX = 'estate'
+
+
+class _NullTimer:
+    # Shared by every disabled timer call: no clock reads, no allocation
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    # Per-stage timers and event counters of the training and prediction hot paths. Off by default: a disabled
+    # timer() returns a shared no-op context and count() returns at once, and the per-row / per-node counts are
+    # behind `if metrics.enabled` at the call sites. Timers of nested stages overlap (build_tree includes
+    # best_split); timers of worker processes that report back (forest training) add up their CPU time.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            calls, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drain(self):
+        # State collected so far, handed to merge() in the parent process; resets this process's state
+        with self.lock:
+            state = {'timers': self.timers, 'counters': self.counters}
+            self.timers = {}
+            self.counters = {}
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for name, (calls, total, longest) in state['timers'].items():
+                own_calls, own_total, own_longest = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (own_calls + calls, own_total + total, max(own_longest, longest))
+            for name, n in state['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        with self.lock:
+            timers = {name: {'calls': calls, 'total_seconds': total, 'mean_seconds': total / calls,
+                             'max_seconds': longest}
+                      for name, (calls, total, longest) in sorted(self.timers.items())}
+            counters = dict(sorted(self.counters.items()))
+        # Ratios that are only meaningful together
+        searches = counters.get('cart.split_searches')
+        if searches:
+            counters['cart.thresholds_per_search'] = counters.get('cart.thresholds_evaluated', 0) / searches
+        lookups = counters.get('cache.hits', 0) + counters.get('cache.misses', 0)
+        if lookups:
+            counters['cache.hit_rate'] = counters.get('cache.hits', 0) / lookups
+        return {'timers': timers, 'counters': counters}
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        # Text exposition format: one labelled series per stage for the timers, one metric per counter
+        summary = self.summary()
+        lines = []
+        for metric, field, kind in (('stage_seconds_total', 'total_seconds', 'counter'),
+                                    ('stage_calls_total', 'calls', 'counter'),
+                                    ('stage_max_seconds', 'max_seconds', 'gauge')):
+            lines.append(f'# TYPE {prefix}_{metric} {kind}')
+            for name, timer in summary['timers'].items():
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {timer[field]}')
+        for name, value in summary['counters'].items():
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+            is_ratio = isinstance(value, float)
+            if not is_ratio:
+                metric += '_total'
+            lines.append(f"# TYPE {metric} {'gauge' if is_ratio else 'counter'}")
+            lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Prometheus text for .prom / .txt files, JSON otherwise
+        text = self.to_prometheus() if os.path.splitext(path)[1] in ('.prom', '.txt') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+# The process-wide instance every instrumented module reports to
+metrics = Metrics(enabled=os.environ.get(ENV_VARIABLE, '') not in ('', '0'))
@@ -0,0 +1,110 @@
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src.utils.instrumentation import metrics
+
+# Every cache alive in this process, so that saving new models can invalidate all of them
+_live_caches = weakref.WeakSet()
+
+def invalidate_all():
+    for cache in list(_live_caches):
+        cache.clear()
+
+class PredictionCache:
+    # LRU memo of ensemble predictions keyed on (artifact id, feature tuple). Entries of a previous artifact are
+    # dropped as soon as a lookup names a new one. ttl (seconds) optionally bounds how long an entry is reused.
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        _live_caches.add(self)
+
+    def _keys(self, features):
+        # Canonical form: float64 values (3 and 3.0 are the same key) with -0.0 folded into 0.0
+        rows = np.asarray(features, dtype=np.float64) + 0.0
+        return [tuple(row) for row in rows.tolist()]
+
+    def _switch_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def lookup(self, features, version):
+        # Cached value per row, None for the rows that have to be predicted
+        now = time.monotonic()
+        results = []
+        with self.lock:
+            self._switch_version(version)
+            for key in self._keys(features):
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    del self.entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    results.append(entry[0])
+        if metrics.enabled:
+            n_hits = sum(value is not None for value in results)
+            metrics.count('cache.hits', n_hits)
+            metrics.count('cache.misses', len(results) - n_hits)
+        return results
+
+    def store(self, features, version, values):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self._switch_version(version)
+            for key, value in zip(self._keys(features), values):
+                self.entries[key] = (value, expires_at)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def start_predict(self, features, version):
+        # First half of predict(), for callers that compute the misses themselves (e.g. awaiting them):
+        # returns the features, the cached value per row and the indices of the rows that have to be predicted
+        features = np.asarray(features, dtype=np.float64)
+        cached = self.lookup(features, version)
+        return features, cached, [i for i, value in enumerate(cached) if value is None]
+
+    def finish_predict(self, features, version, cached, missing, predicted):
+        # Second half: predicted is the tuple of per-row arrays for features[missing] (ignored without misses).
+        # Stores it and returns the tuple of arrays for all rows.
+        if missing:
+            computed = list(zip(*(np.asarray(output).tolist() for output in predicted)))
+            self.store(features[missing], version, computed)
+            for i, value in zip(missing, computed):
+                cached[i] = value
+        return tuple(np.array(column) for column in zip(*cached)) if cached else ()
+
+    def predict(self, features, version, predict_fn):
+        # predict_fn(features) -> tuple of per-row arrays; it only sees the rows that missed.
+        # Returns the same tuple of arrays for all rows.
+        features, cached, missing = self.start_predict(features, version)
+        predicted = predict_fn(features[missing]) if missing else None
+        return self.finish_predict(features, version, cached, missing, predicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'expirations': self.expirations}
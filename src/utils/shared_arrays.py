@@ -0,0 +1,32 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Blocks attached by a worker process stay open for its whole lifetime
+_attached_blocks = {}
+
+def share_arrays(*arrays):
+    # Copies the arrays into shared memory once; the returned handles are tiny and cheap to pickle
+    blocks, handles = [], []
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        handles.append((block.name, array.shape, array.dtype.str))
+    return blocks, handles
+
+def attach_arrays(handles):
+    arrays = []
+    for name, shape, dtype in handles:
+        if name not in _attached_blocks:
+            _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached_blocks[name].buf)
+        array.flags.writeable = False
+        arrays.append(array)
+    return arrays
+
+def release_arrays(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
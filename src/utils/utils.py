@@ -1,9 +1,33 @@
+import numpy as np
+
+def as_float_array(X):
+    X = np.asarray(X)
+    if X.dtype != np.float32 and X.dtype != np.float64:
+        X = X.astype(np.float64)
+    return X
+
 def train_test_split(X, y, test_size=0.2):
     split_index = int(len(X) * (1 - test_size))
     return X[:split_index], X[split_index:], y[:split_index], y[split_index:]
 
 def calculate_metrics(y_real, y_pred):
-    n = len(y_real)
-    mae = sum(abs(y_real[i] - y_pred[i]) for i in range(n)) / n
-    mape = (sum(abs((y_real[i] - y_pred[i]) / y_real[i]) for i in range(n)) / n) * 100
-    return mae, mape
\ No newline at end of file
+    y_real = np.asarray(y_real, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    mae = float(np.mean(np.abs(y_real - y_pred)))
+    mape = float(np.mean(np.abs((y_real - y_pred) / y_real)) * 100)
+    return mae, mape
+
+def row_quantiles(values, quantiles):
+    # Quantiles of every row of a (rows x n) matrix, linear interpolation like np.quantile's default: one sort
+    # per row and two gathers per quantile instead of a partition per quantile. Returns (rows x len(quantiles)).
+    values = np.sort(values, axis=1)
+    positions = np.asarray(quantiles, dtype=np.float64) * (values.shape[1] - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, values.shape[1] - 1)
+    fraction = positions - lower
+    return values[:, lower] * (1 - fraction) + values[:, upper] * fraction
+
+def rooms_by_area(area, breakpoints):
+    # Room count of the area bucket: 1 below the first breakpoint, 2 below the second, ... and
+    # len(breakpoints) + 1 from the last one up (also for a missing area)
+    return np.searchsorted(breakpoints, np.asarray(area, dtype=np.float64), side='right') + 1
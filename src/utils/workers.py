@@ -0,0 +1,27 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# State of a worker process: what the pool's setup function returned, built once when the process starts
+_worker_state = None
+
+def resolve_n_jobs(n_jobs, n_tasks=None):
+    # n_jobs as given on the command lines: -1 uses every core, 0 / None / 1 work in the calling process.
+    # Never more workers than tasks when their number is known.
+    n_jobs = n_jobs or 1
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if n_tasks is not None:
+        n_jobs = min(n_jobs, n_tasks)
+    return max(1, n_jobs)
+
+def _init_worker(setup, args):
+    global _worker_state
+    _worker_state = setup(*args)
+
+def worker_pool(n_workers, setup, *args):
+    # Every worker runs setup(*args) once (attach shared arrays, load an artifact, ...); tasks read the result
+    # with worker_state(). setup must be a module-level function so it can be pickled.
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(setup, args))
+
+def worker_state():
+    return _worker_state